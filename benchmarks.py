@@ -0,0 +1,612 @@
+import ast
+import functools
+import os
+import pickle
+import tracemalloc
+
+import astor
+import black
+import pytest
+from code_crafter import (
+    Client,
+    Code,
+    File,
+    Operation,
+    Server,
+    _render,
+    async_batch,
+    batch,
+    get_ast_node_from_value,
+)
+
+
+def black_format(text, line_length):
+    # Uncached, unlike the formatter File uses by default
+    return black.format_str(text, mode=black.FileMode(line_length=line_length))
+
+
+def make_module(n_assignments):
+    """Generate a synthetic config module with many top-level assignments."""
+    lines = []
+    for i in range(n_assignments):
+        lines.append(f"list_{i} = [{i}, {i + 1}, 'x']")
+        lines.append(f"dict_{i} = {{'key': {i}, 'other': 'val'}}")
+        lines.append(f"set_{i} = set({i}, {i + 1})")
+    return "\n".join(lines) + "\n"
+
+
+# Container sizes for the per-method benchmarks. 1M elements takes several minutes, so
+# it only runs with CODE_CRAFTER_BENCHMARK_LARGE=1
+SCALES = [100, 10_000]
+if os.environ.get("CODE_CRAFTER_BENCHMARK_LARGE"):
+    SCALES.append(1_000_000)
+
+
+def make_container(kind, n, call=False):
+    """Generate ``data = ...`` holding a dict, list or set of n elements."""
+    if kind == "dict":
+        if call:
+            return "data = dict(" + ", ".join(f"key_{i}={i}" for i in range(n)) + ")\n"
+        return "data = {" + ", ".join(f"'key_{i}': {i}" for i in range(n)) + "}\n"
+    elements = ", ".join(str(i) for i in range(n))
+    if call:
+        return f"data = {kind}({elements})\n"
+    return f"data = [{elements}]\n" if kind == "list" else f"data = {{{elements}}}\n"
+
+
+def make_nested(depth):
+    """Generate ``config = ...`` with dicts and lists nested ``depth`` levels deep.
+
+    The outermost value is a dict when ``depth`` is even.
+    """
+    value = "[1, 'leaf']"
+    for i in range(depth):
+        value = (
+            f"{{'level_{i}': {value}, 'other': [{i}]}}" if i % 2 else f"[{value}, {i}]"
+        )
+    return f"config = {value}\n"
+
+
+@functools.lru_cache(maxsize=None)
+def _pickled_tree(source):
+    return pickle.dumps(ast.parse(source))
+
+
+def fresh_code(source):
+    """A Code for ``source``, unpickling a cached tree because that's faster than parsing."""
+    return Code(source, tree=pickle.loads(_pickled_tree(source)))
+
+
+@pytest.fixture(scope="module")
+def large_module():
+    return make_module(7000)
+
+
+def _walk_find_list(tree, name):
+    # The lookup strategy used before the name index existed
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Assign)
+            and isinstance(node.targets[0], ast.Name)
+            and node.targets[0].id == name
+            and isinstance(node.value, ast.List)
+        ):
+            return node
+
+
+def test_find_200_names_walk(benchmark, large_module):
+    code = Code(large_module)
+    names = [f"list_{i}" for i in range(0, 7000, 35)]
+    benchmark(lambda: [_walk_find_list(code.tree, name) for name in names])
+
+
+def test_find_200_names_index(benchmark, large_module):
+    code = Code(large_module)
+    names = [f"list_{i}" for i in range(0, 7000, 35)]
+
+    def run():
+        code.invalidate_index()
+        return [code.find_list(name) for name in names]
+
+    benchmark(run)
+
+
+def test_find_all_200_names(benchmark, large_module):
+    code = Code(large_module)
+    names = [f"list_{i}" for i in range(0, 7000, 35)]
+    benchmark(code.find_all, names, kinds=["list"])
+
+
+@pytest.mark.parametrize("write_mode", ["full", "splice", "patch"])
+def test_file_write_one_edit(benchmark, tmp_path, write_mode):
+    path = tmp_path / "module.py"
+    source = make_module(1000)
+
+    def run():
+        path.write_text(source)
+        with File(str(path), write_mode=write_mode) as file:
+            file.find_list("list_500").append(1)
+
+    benchmark.pedantic(run, rounds=3)
+
+
+DICT_OPERATIONS = {
+    "get": lambda data, n: data.get(f"key_{n // 2}"),
+    "pop": lambda data, n: data.pop(f"key_{n // 2}"),
+    "update_existing": lambda data, n: data.update({f"key_{n // 2}": -1}),
+    "update_new": lambda data, n: data.update({"new_key": -1}),
+    "clear": lambda data, n: data.clear(),
+    "items": lambda data, n: list(data.items()),
+    "keys": lambda data, n: list(data.keys()),
+    "values": lambda data, n: list(data.values()),
+    "iter": lambda data, n: list(data),
+    "len": lambda data, n: len(data),
+    "to_python": lambda data, n: data.to_python(),
+}
+
+LIST_OPERATIONS = {
+    "append": lambda data, n: data.append(-1),
+    "insert": lambda data, n: data.insert(0, -1),
+    "pop": lambda data, n: data.pop(n // 2),
+    "remove": lambda data, n: data.remove(n // 2),
+    "clear": lambda data, n: data.clear(),
+    "reverse": lambda data, n: data.reverse(),
+    "setitem": lambda data, n: data.__setitem__(n // 2, -1),
+    "setitem_slice": lambda data, n: data.__setitem__(slice(0, n // 10), range(10)),
+    "extend": lambda data, n: data.extend(range(100)),
+    "remove_all": lambda data, n: data.remove_all(range(0, n, 10)),
+    "filter": lambda data, n: data.filter(lambda value: value % 2),
+    "sort": lambda data, n: data.sort(reverse=True),
+    "len": lambda data, n: len(data),
+    "iter": lambda data, n: list(data),
+    "to_python": lambda data, n: data.to_python(),
+}
+
+SET_OPERATIONS = {
+    "add_new": lambda data, n: data.add(-1),
+    "add_existing": lambda data, n: data.add(n // 2),
+    "remove": lambda data, n: data.remove(n // 2),
+    "discard": lambda data, n: data.discard(-1),
+    "update": lambda data, n: data.update(range(n, n + 100)),
+    "contains": lambda data, n: n // 2 in data,
+    "len": lambda data, n: len(data),
+    "iter": lambda data, n: list(data),
+    "to_python": lambda data, n: data.to_python(),
+}
+
+OPERATIONS = {"dict": DICT_OPERATIONS, "list": LIST_OPERATIONS, "set": SET_OPERATIONS}
+
+
+@pytest.mark.parametrize("n", SCALES)
+@pytest.mark.parametrize("call", [False, True], ids=["literal", "call"])
+@pytest.mark.parametrize(
+    "kind, operation",
+    [(kind, operation) for kind in OPERATIONS for operation in OPERATIONS[kind]],
+)
+def test_wrapper_method(benchmark, kind, operation, call, n):
+    # Each round gets a freshly found container, so the lazily built key index is
+    # included in the first lookup
+    source = make_container(kind, n, call)
+    find = {"dict": Code.find_dict, "list": Code.find_list, "set": Code.find_set}[kind]
+
+    def setup():
+        return (find(fresh_code(source), "data"), n), {}
+
+    benchmark.pedantic(
+        OPERATIONS[kind][operation], setup=setup, rounds=20 if n <= 10_000 else 3
+    )
+
+
+@pytest.mark.parametrize("n_assignments", [100, 10_000])
+def test_find_by_module_size(benchmark, n_assignments):
+    source = make_module(n_assignments)
+    code = fresh_code(source)
+    name = f"dict_{n_assignments // 2}"
+
+    def run():
+        code.invalidate_index()
+        return code.find_dict(name)
+
+    benchmark(run)
+
+
+@pytest.mark.parametrize("depth", [10, 90])
+@pytest.mark.parametrize("operation", ["parse", "load", "find_and_edit"])
+def test_deeply_nested(benchmark, depth, operation):
+    source = make_nested(depth)
+    if operation == "parse":
+        benchmark(Code, source)
+    elif operation == "load":
+        code = Code(source)
+        benchmark(code.load, "config")
+    else:
+        benchmark.pedantic(
+            lambda code: code.find_dict("config").update({"new": [1, 2]}),
+            setup=lambda: ((fresh_code(source),), {}),
+            rounds=20,
+        )
+
+
+@pytest.mark.parametrize(
+    "n_assignments, write_mode, engine",
+    [
+        (100, "full", "ast"),
+        (100, "splice", "ast"),
+        (1000, "full", "ast"),
+        (1000, "splice", "ast"),
+        (10_000, "splice", "ast"),
+        (10_000, "splice", "tokens"),
+        (100_000, "splice", "tokens"),
+    ],
+)
+def test_file_round_trip(benchmark, tmp_path, n_assignments, write_mode, engine):
+    path = tmp_path / "module.py"
+    source = make_module(n_assignments)
+
+    def setup():
+        path.write_text(source)
+
+    def run():
+        with File(str(path), write_mode=write_mode, engine=engine) as file:
+            file.find_list(f"list_{n_assignments // 2}").append(1)
+            file.find_dict(f"dict_{n_assignments // 2}").update({"key": -1})
+            file.find_set(f"set_{n_assignments // 2}").add(-1)
+
+    benchmark.pedantic(run, setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize("engine", ["ast", "tokens"])
+def test_file_edit_engine(benchmark, tmp_path, engine):
+    path = tmp_path / "module.py"
+    source = make_module(40_000)  # ~4 MB
+
+    def run():
+        path.write_text(source)
+        with File(str(path), engine=engine, write_mode="splice") as file:
+            file.find_list("list_20000").append(1)
+
+    benchmark.pedantic(run, rounds=3)
+
+
+@pytest.mark.parametrize("read_mode", ["full", "mmap"])
+def test_file_edit_peak_memory(benchmark, tmp_path, read_mode):
+    path = tmp_path / "module.py"
+    path.write_text(make_module(40_000))  # ~4 MB
+
+    def run():
+        tracemalloc.start()
+        with File(str(path), engine="tokens", read_mode=read_mode) as file:
+            file.find_list("list_20000").append(1)
+        benchmark.extra_info["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    benchmark.pedantic(run, rounds=3)
+
+
+@pytest.mark.parametrize("n_assignments", [1000, 10_000, 40_000])
+def test_splice_format_one_edit(benchmark, n_assignments):
+    # Only the edited statement is formatted, so this should stay flat as the file grows
+    code = Code(make_module(n_assignments), engine="tokens")
+    code.find_list(f"list_{n_assignments // 2}").extend(range(50))
+
+    # Plan the splice without joining the (growing) unchanged text
+    benchmark(code._splice_chunks, black_format)
+
+
+@pytest.mark.parametrize("profile", [False, True])
+def test_find_and_edit_profiling_overhead(benchmark, large_module, profile):
+    from code_crafter import Profile
+
+    code = Code(large_module, profile=Profile() if profile else None)
+    names = [f"list_{i}" for i in range(0, 7000, 7)]
+    benchmark(lambda: [code.find_list(name).append(1) for name in names])
+
+
+def _append_to_list_0(file):
+    file.find_list("list_0").append(1)
+
+
+@pytest.mark.parametrize("max_workers", sorted({1, os.cpu_count() or 1}))
+def test_batch_1000_files(benchmark, tmp_path, max_workers):
+    source = make_module(20)
+    paths = [str(tmp_path / f"module_{i}.py") for i in range(1000)]
+
+    def setup():
+        for path in paths:
+            with open(path, "w") as f:
+                f.write(source)
+
+    benchmark.pedantic(
+        batch,
+        args=(paths, _append_to_list_0),
+        kwargs=dict(max_workers=max_workers, chunksize=16),
+        setup=setup,
+        rounds=1,
+    )
+
+
+async def _max_loop_lag(work, interval=0.005):
+    """Run ``work`` while measuring the longest time the event loop was blocked."""
+    import asyncio
+    import time
+
+    lags = []
+
+    async def heartbeat():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - start - interval)
+
+    task = asyncio.ensure_future(heartbeat())
+    await work
+    task.cancel()
+    return max(lags, default=0.0)
+
+
+@pytest.mark.parametrize("api", ["blocking", "async"])
+def test_edit_200_files_loop_lag(benchmark, tmp_path, api):
+    import asyncio
+
+    source = make_module(300)
+    paths = [str(tmp_path / f"module_{i}.py") for i in range(200)]
+
+    def setup():
+        for path in paths:
+            with open(path, "w") as f:
+                f.write(source)
+
+    async def blocking():
+        for path in paths:
+            with File(path, write_mode="splice") as file:
+                _append_to_list_0(file)
+            await asyncio.sleep(0)
+
+    async def edit_all():
+        if api == "async":
+            await async_batch(paths, _append_to_list_0, write_mode="splice")
+        else:
+            await blocking()
+
+    def run():
+        benchmark.extra_info["max_loop_lag_ms"] = 1000 * asyncio.run(
+            _max_loop_lag(edit_all())
+        )
+
+    benchmark.pedantic(run, setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_replay_5000_operations(benchmark, compact):
+    from code_crafter import compact_log
+
+    source = "flags = {}\nnames = []\n"
+    code = Code(source)
+    flags, names = code.find_dict("flags"), code.find_list("names")
+    for i in range(2500):
+        flags.update({f"flag_{i % 500}": i})
+        names.append(f"name_{i}")
+    operations = code.log
+
+    def run():
+        Code(source).replay(compact_log(operations) if compact else operations)
+
+    benchmark.pedantic(run, rounds=3)
+
+
+@pytest.mark.parametrize("size", [10_000, 100_000])
+def test_dict_bulk_update(benchmark, size):
+    source = "flags = {" + ", ".join(f"'flag_{i}': {i}" for i in range(size)) + "}\n"
+    updates = {f"flag_{i}": -i for i in range(0, 2 * size, 2 * size // 2000)}
+
+    def setup():
+        return (Code(source).find_dict("flags"),), {}
+
+    benchmark.pedantic(lambda flags: flags.update(updates), setup=setup, rounds=3)
+
+
+def test_set_bulk_update(benchmark):
+    source = "allowed = {" + ", ".join(f"'name_{i}'" for i in range(50_000)) + "}\n"
+    values = [f"name_{i}" for i in range(0, 100_000, 20)]
+
+    def setup():
+        return (Code(source).find_set("allowed"),), {}
+
+    benchmark.pedantic(lambda allowed: allowed.update(values), setup=setup, rounds=3)
+
+
+@pytest.fixture(scope="module")
+def list_100k_source():
+    return (
+        "values = ["
+        + ", ".join(str((i * 7919) % 100_003) for i in range(100_000))
+        + "]\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "operation",
+    [
+        lambda values: values.extend(range(100_000)),
+        lambda values: values.clear(),
+        lambda values: values.remove_all(range(0, 100_003, 3)),
+        lambda values: values.filter(lambda value: value % 2),
+        lambda values: values.sort(),
+        lambda values: values.__setitem__(slice(1000, 2000), range(5000)),
+    ],
+    ids=["extend", "clear", "remove_all", "filter", "sort", "setitem_slice"],
+)
+@pytest.mark.parametrize("wrapper", ["literal", "call"])
+def test_list_bulk_operation(benchmark, list_100k_source, operation, wrapper):
+    source = list_100k_source
+    if wrapper == "call":
+        source = source.replace("[", "list(").replace("]", ")")
+
+    def setup():
+        return (Code(source).find_list("values"),), {}
+
+    benchmark.pedantic(operation, setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        [{"id": i, "tags": ("a", "b"), "scores": [i, i + 0.5]} for i in range(20_000)],
+        [("x", 1)] * 100_000,
+        functools.reduce(lambda inner, _: [inner, 1], range(20_000), []),
+    ],
+    ids=["records", "repeated_tuples", "deep"],
+)
+def test_get_ast_node_from_value(benchmark, payload):
+    benchmark(get_ast_node_from_value, payload)
+
+
+@pytest.mark.parametrize("method", ["to_python", "literal_eval_source"])
+def test_dict_to_python(benchmark, method):
+    source = (
+        "table = {" + ", ".join(f"'key_{i}': [{i}, 'v']" for i in range(5_000)) + "}\n"
+    )
+    table = Code(source).find_dict("table")
+    if method == "to_python":
+        benchmark.pedantic(table.to_python, rounds=3)
+    else:
+        benchmark.pedantic(
+            lambda: ast.literal_eval(astor.to_source(table.node.value)), rounds=1
+        )
+
+
+def test_import_time(benchmark):
+    import subprocess
+    import sys
+
+    benchmark.pedantic(
+        subprocess.run,
+        args=([sys.executable, "-c", "import code_crafter"],),
+        kwargs=dict(check=True),
+        rounds=5,
+    )
+
+
+COLD_EDIT = """
+import sys
+from code_crafter import File
+
+with File(sys.argv[1], write_mode="splice") as file:
+    file.find_list("list_0").append(1)
+"""
+
+
+@pytest.mark.parametrize("path", ["cold_process", "server", "server_coalesced"])
+def test_edit_latency(benchmark, tmp_path, path):
+    """Per-edit latency of a build hook, as a new process or as a server request."""
+    import subprocess
+    import sys
+    import threading
+
+    module = tmp_path / "module.py"
+    module.write_text(make_module(300))
+    operation = Operation("list", "list_0", "append", (1,))
+    if path == "cold_process":
+        benchmark.pedantic(
+            subprocess.run,
+            args=([sys.executable, "-c", COLD_EDIT, str(module)],),
+            kwargs=dict(check=True),
+            rounds=5,
+        )
+        return
+
+    socket_path = str(tmp_path / "server.sock")
+    server = Server(socket_path, flush_delay=0.05, write_mode="splice")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        while not os.path.exists(socket_path):
+            thread.join(0.01)
+        with Client(socket_path) as client:
+            flush = path == "server"
+            benchmark.pedantic(
+                client.edit, args=(str(module), [operation], flush), rounds=20
+            )
+    finally:
+        with Client(socket_path) as client:
+            client.shutdown()
+        thread.join()
+
+
+def _walk_to(value_node, *keys):
+    """Find a nested value by scanning each level, as one would without Code.at."""
+    for key in keys:
+        value_node = next(
+            value
+            for key_node, value in zip(value_node.keys, value_node.values)
+            if key_node.value == key
+        )
+    return value_node
+
+
+@pytest.mark.parametrize("lookup", ["at", "walk"])
+def test_nested_path_edit(benchmark, lookup):
+    services = ", ".join(
+        f"'service_{i}': {{"
+        + ", ".join(f"'option_{j}': {j}" for j in range(50))
+        + ", 'workers': [1]}"
+        for i in range(2_000)
+    )
+    code = Code(f"CONFIG = {{'services': {{{services}}}}}\n")
+    path = ("services", "service_1999", "workers")
+
+    def edit():
+        if lookup == "at":
+            workers = code.at("CONFIG", *path)
+        else:
+            node = _walk_to(code.find_dict("CONFIG").node.value, *path)
+            workers = code._wrap(node, code.find_dict("CONFIG").stmt, None)
+        workers.append(1)
+
+    benchmark(edit)
+
+
+@pytest.mark.parametrize("dtype", ["int64", "float64"])
+@pytest.mark.parametrize("conversion", ["array", "tolist"])
+def test_numpy_array_to_source(benchmark, dtype, conversion):
+    """Render a 1M-element array, directly or converted to a list first."""
+    numpy = pytest.importorskip("numpy")
+    values = (numpy.arange(1_000_000) / 7).astype(dtype)
+
+    def to_source():
+        value = values if conversion == "array" else values.tolist()
+        return _render(get_ast_node_from_value(value))
+
+    benchmark.pedantic(to_source, rounds=3)
+
+
+def test_list_extend_with_numpy_array(benchmark):
+    numpy = pytest.importorskip("numpy")
+    values = numpy.arange(1_000_000)
+    benchmark.pedantic(
+        lambda code: code.find_list("data").extend(values),
+        setup=lambda: ((Code("data = []\n"),), {}),
+        rounds=3,
+    )
+
+
+@pytest.mark.parametrize("coordination", ["last_writer_wins", "lock", "queue"])
+def test_shared_file_writers(benchmark, tmp_path, coordination):
+    """400 edits to one module from 4 worker processes editing it at once."""
+    path = str(tmp_path / "registry.py")
+    kwargs = {} if coordination == "last_writer_wins" else {coordination: True}
+
+    def setup():
+        with open(path, "w") as f:
+            f.write(make_module(100))
+
+    benchmark.pedantic(
+        batch,
+        args=([path] * 400, _append_to_list_0),
+        kwargs=dict(max_workers=4, formatter="none", **kwargs),
+        setup=setup,
+        rounds=3,
+    )
+    with File(path) as file:
+        kept = len(file.find_list("list_0")) - 3
+    benchmark.extra_info["lost_edits"] = 400 - kept
@@ -1,34 +1,769 @@
 import abc
+import array
 import ast
-from typing import Union, Any, Type, Optional
-
-import astor
-import black
-
-# Adjusted to support more general use of ast.Constant in newer Python versions
+import collections
+import contextlib
+import copy
+import dataclasses
+import enum
+import fnmatch
+import functools
+import hashlib
+import mmap
+import os
+import pickle
+import re
+import sys
+import time
+import traceback
+from typing import (
+    Union,
+    Any,
+    Type,
+    Optional,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Tuple,
+)
+
+
+def _constant(value: Any) -> ast.Constant:
+    return ast.Constant(value=value)
+
+
+def _call(func: str, args: list = (), keywords: list = ()) -> ast.Call:
+    return ast.Call(
+        func=ast.Name(id=func, ctx=ast.Load()), args=list(args), keywords=list(keywords)
+    )
+
+
+def _dataclass_node(value: Any) -> ast.Call:
+    keywords = [
+        ast.keyword(arg=field.name, value=getattr(value, field.name))
+        for field in dataclasses.fields(value)
+        if field.init
+    ]
+    return _call(type(value).__name__, keywords=keywords)
+
+
+def _enum_node(value: enum.Enum) -> ast.Attribute:
+    return ast.Attribute(
+        value=ast.Name(id=type(value).__name__, ctx=ast.Load()),
+        attr=value.name,
+        ctx=ast.Load(),
+    )
+
+
+# Arrays of at least this many numbers are rendered to source text in one go, instead
+# of building a node per element
+_RAW_LITERAL_MIN_SIZE = 1000
+_NUMERIC_TYPECODES = frozenset("bBhHiIlLqQfd")  # array.array
+_NUMERIC_FORMATS = frozenset("?bBhHiIlLqQnNfd")  # memoryview (struct module)
+_NUMERIC_KINDS = frozenset("biufc")  # NumPy dtype
+
+
+def _is_ndarray(value: Any) -> bool:
+    # NumPy is only checked for if it has been imported, since values can't be
+    # arrays otherwise
+    numpy = sys.modules.get("numpy")
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def _is_numeric_array(value: Any) -> bool:
+    """Whether every element of an array is a bool, int, float or complex."""
+    if isinstance(value, range):
+        return True
+    if isinstance(value, array.array):
+        return value.typecode in _NUMERIC_TYPECODES
+    if isinstance(value, memoryview):
+        return value.format.lstrip("@") in _NUMERIC_FORMATS
+    return value.dtype.kind in _NUMERIC_KINDS
+
+
+def _array_size(value: Any) -> int:
+    if isinstance(value, memoryview):
+        return value.nbytes // value.itemsize
+    if isinstance(value, (range, array.array)):
+        return len(value)
+    return value.size
+
+
+class _RawList(ast.List):
+    """
+    A list node built from the text of a literal too large to build node by node.
+
+    The element nodes are only parsed when something reads ``elts``. Until then,
+    :func:`_render` writes the text as it is, and :func:`get_value_from_ast_node`
+    reads the value straight from it.
+    """
+
+    def __init__(self, text: Optional[str] = None, **kwargs):
+        super().__init__(ctx=ast.Load(), **kwargs)
+        self.text = text
+
+    @property
+    def elts(self) -> list:
+        if self.text is not None:
+            self.__dict__["elts"] = ast.parse(self.text, mode="eval").body.elts
+            self.text = None
+        return self.__dict__["elts"]
+
+    @elts.setter
+    def elts(self, elts: list) -> None:
+        self.__dict__["elts"] = elts
+        self.text = None
+
+
+# ast.unparse and astor look up how to render a node by its class name
+_RawList.__name__ = "List"
+
+
+def _array_node(value: Any) -> ast.AST:
+    """Build a list node for a range, array.array, memoryview or NumPy array."""
+    items = list(value) if isinstance(value, range) else value.tolist()
+    if not isinstance(items, list):
+        # A 0-dimensional array holds a single value
+        return _build_node(items)
+    if _array_size(value) >= _RAW_LITERAL_MIN_SIZE and _is_numeric_array(value):
+        text = repr(items)
+        # inf and nan aren't literals, and are the only reprs of numbers with an "n"
+        if "n" not in text:
+            return _RawList(text)
+    return ast.List(elts=items, ctx=ast.Load())
+
+
+def _element_nodes(values: Iterable) -> list:
+    """Build the nodes for the elements of ``values``, e.g. to extend a list with."""
+    if isinstance(values, (range, array.array, memoryview)) or _is_ndarray(values):
+        if getattr(values, "ndim", 1) == 1 and _is_numeric_array(values):
+            items = list(values) if isinstance(values, range) else values.tolist()
+            return list(map(_constant, items))
+        if _is_ndarray(values):
+            # Rows are arrays too, so large ones are rendered in one go
+            return [get_ast_node_from_value(row) for row in values]
+        values = values.tolist()
+    return [get_ast_node_from_value(value) for value in values]
+
+
+# Maps Python types to functions building the corresponding AST node. Builders leave
+# child values as plain Python objects in the node's elts/keys/values/args and keyword
+# values; get_ast_node_from_value converts them iteratively, so nesting depth isn't
+# limited by the recursion limit. Enums and dataclass instances are handled separately.
 ast_map = {
-    list: lambda x: ast.List(
-        elts=[get_ast_node_from_value(i) for i in x], ctx=ast.Load()
-    ),
-    dict: lambda x: ast.Dict(
-        keys=[get_ast_node_from_value(k) for k in x.keys()],
-        values=[get_ast_node_from_value(v) for v in x.values()],
-    ),
-    tuple: lambda x: ast.Tuple(
-        elts=[get_ast_node_from_value(i) for i in x], ctx=ast.Load()
-    ),
-    set: lambda x: ast.Set(elts=[get_ast_node_from_value(i) for i in x]),
+    list: lambda x: ast.List(elts=list(x), ctx=ast.Load()),
+    dict: lambda x: ast.Dict(keys=list(x.keys()), values=list(x.values())),
+    tuple: lambda x: ast.Tuple(elts=list(x), ctx=ast.Load()),
+    # An empty set literal would be a dict
+    set: lambda x: ast.Set(elts=list(x)) if x else _call("set"),
+    frozenset: lambda x: _call("frozenset", [ast.Set(elts=list(x))] if x else []),
+    str: _constant,
+    bytes: _constant,
+    int: _constant,
+    float: _constant,
+    complex: _constant,
+    bool: _constant,
+    type(None): _constant,
+    type(Ellipsis): _constant,
+    range: _array_node,
+    array.array: _array_node,
+    memoryview: _array_node,
     # Additional types can be added here
 }
 
+_CHILD_FIELDS = ("elts", "keys", "values", "args", "keywords")
+
+
+def _build_node(value: Any) -> ast.AST:
+    builder = ast_map.get(type(value))
+    if builder is not None:
+        return builder(value)
+    if isinstance(value, enum.Enum):
+        return _enum_node(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return _dataclass_node(value)
+    numpy = sys.modules.get("numpy")
+    if numpy is not None:
+        if isinstance(value, numpy.ndarray):
+            return _array_node(value)
+        if isinstance(value, numpy.generic):
+            return _build_node(value.item())
+    return ast.Constant(value=value)
+
 
 def get_ast_node_from_value(value):
     """Get the corresponding AST node from a Python value, with fallback for unsupported types."""
-    return ast_map.get(type(value), lambda x: ast.Constant(value=x))(value)
+    constant_types = {
+        type_ for type_, builder in ast_map.items() if builder is _constant
+    }
+    # Raw lists have no child values to convert
+    child_fields = {_RawList: []}
+    root = [value]
+    # Slots (a list and an index, or a keyword and None) still holding a raw value
+    stack = [(root, 0)]
+    nodes = []
+    while stack:
+        parent, i = stack.pop()
+        if i is None:
+            node = parent.value = _build_node(parent.value)
+        else:
+            child = parent[i]
+            builder = ast_map.get(type(child))
+            node = parent[i] = _build_node(child) if builder is None else builder(child)
+
+        while True:
+            fields = child_fields.get(node.__class__)
+            if fields is None:
+                fields = child_fields[node.__class__] = [
+                    field for field in _CHILD_FIELDS if field in node._fields
+                ]
+            for field in fields:
+                children = getattr(node, field)
+                for j, child in enumerate(children):
+                    if type(child) in constant_types:
+                        children[j] = ast.Constant(value=child)
+                    elif not isinstance(child, ast.AST):
+                        stack.append((children, j))
+                    elif isinstance(child, ast.keyword):
+                        if not isinstance(child.value, ast.AST):
+                            stack.append((child, None))
+                    else:
+                        # Nodes built along with the parent, e.g. the set in frozenset()
+                        nodes.append(child)
+            if not nodes:
+                break
+            node = nodes.pop()
+
+    return root[0]
+
+
+_CONSTRUCTORS = {
+    "dict": dict,
+    "list": list,
+    "set": set,
+    "frozenset": frozenset,
+    "tuple": tuple,
+}
+
+
+def get_value_from_ast_node(node: ast.AST) -> Any:
+    """
+    Get the Python value of an AST node holding a literal, without unparsing it.
+
+    Calls to ``dict``, ``list``, ``set``, ``frozenset`` and ``tuple`` are supported. With
+    a single container argument they behave as in Python; otherwise their arguments
+    are taken as the elements, as in the ``FunctionCall*`` wrappers.
+
+    Raises
+    ------
+    ValueError
+        If the node is not a literal.
+    """
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, _RawList) and node.text is not None:
+        return _raw_literal_value(node.text)
+    if isinstance(node, ast.List):
+        return [get_value_from_ast_node(elt) for elt in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(get_value_from_ast_node(elt) for elt in node.elts)
+    if isinstance(node, ast.Set):
+        return {get_value_from_ast_node(elt) for elt in node.elts}
+    if isinstance(node, ast.Dict):
+        if None in node.keys:
+            raise ValueError("Can't convert a dict containing ** unpacking")
+        return {
+            get_value_from_ast_node(key): get_value_from_ast_node(value)
+            for key, value in zip(node.keys, node.values)
+        }
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id in _CONSTRUCTORS
+    ):
+        constructor = _CONSTRUCTORS[node.func.id]
+        if any(kw.arg is None for kw in node.keywords) or any(
+            isinstance(arg, ast.Starred) for arg in node.args
+        ):
+            raise ValueError("Can't convert a call with * or ** unpacking")
+        if constructor is dict:
+            if node.args:
+                return dict(
+                    get_value_from_ast_node(node.args[0]),
+                    **{
+                        kw.arg: get_value_from_ast_node(kw.value)
+                        for kw in node.keywords
+                    },
+                )
+            return {kw.arg: get_value_from_ast_node(kw.value) for kw in node.keywords}
+        args = [get_value_from_ast_node(arg) for arg in node.args]
+        if len(node.args) == 1 and isinstance(
+            node.args[0], (ast.List, ast.Tuple, ast.Set)
+        ):
+            return constructor(args[0])
+        return constructor(args)
+    # e.g. negative numbers
+    return ast.literal_eval(node)
+
+
+def _raw_literal_value(text: str) -> Any:
+    """The value of the text of a :class:`_RawList`."""
+    import json
+
+    # Lists of ints and finite floats are also JSON, which is much faster to read
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def _snapshot(value: Any) -> Any:
+    """A deep copy of ``value``, or ``value`` itself if it can't be copied."""
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return value
+
+
+def _mutator(method):
+    """Decorate a wrapper method that modifies the AST so the owning Code can track it."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Consume iterators here, so the logged call can be replayed
+        args = tuple(list(arg) if isinstance(arg, Iterator) else arg for arg in args)
+        if self._mutating:
+            # Called from another mutator, which is the one that gets logged
+            changed = self._changed
+            self._changed = True
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._changed = self._changed or changed
+        profile = self.code.profile if self.code is not None else None
+        self._mutating = True
+        # Methods set this to False when the call turns out to change nothing
+        self._changed = True
+        try:
+            with _NO_PHASE if profile is None else profile.phase("mutate"):
+                result = method(self, *args, **kwargs)
+        finally:
+            self._mutating = False
+        if self.code is not None and self._changed:
+            self.code._mark_modified(self.stmt)
+            if self.name is not None:
+                self.code._forget_paths(self.name)
+                # Copied, so later changes to the arguments don't change the log
+                self.code.log.append(
+                    Operation(
+                        self._kind,
+                        self.name,
+                        method.__name__,
+                        _snapshot(args),
+                        _snapshot(kwargs),
+                    )
+                )
+        return result
+
+    # Marks the methods that operations may call, see :meth:`Code.replay`
+    wrapper._mutator = True
+    return wrapper
+
+
+def _same_constant(old: ast.AST, new: ast.AST) -> bool:
+    """Whether two nodes are constants of the same type and value."""
+    return (
+        isinstance(old, ast.Constant)
+        and isinstance(new, ast.Constant)
+        and type(old.value) is type(new.value)
+        and old.value == new.value
+    )
+
+
+class Operation(NamedTuple):
+    """A call to a modifying method of a container, as recorded in :attr:`Code.log`."""
+
+    kind: str
+    """The kind of container: "dict", "list" or "set"."""
+    name: str
+    """The (qualified) name the container was found under."""
+    method: str
+    args: tuple = ()
+    kwargs: dict = {}
+
+
+def _path_name(name: str, keys: tuple) -> str:
+    """The name of a nested container, e.g. ``CONFIG['services'][0]``."""
+    return name + "".join(f"[{key!r}]" for key in keys)
+
+
+@functools.lru_cache(maxsize=1024)
+def _split_path(name: str) -> tuple:
+    """Split a name written by :func:`_path_name` into the name and the keys."""
+    name, bracket, rest = name.partition("[")
+    if not bracket:
+        return (name,)
+    node = ast.parse("_[" + rest, mode="eval").body
+    keys = []
+    while isinstance(node, ast.Subscript):
+        key = node.slice
+        if sys.version_info < (3, 9):
+            key = key.value
+        keys.append(get_value_from_ast_node(key))
+        node = node.value
+    return (name, *reversed(keys))
+
+
+def serialize_log(operations: Iterable[Operation]) -> str:
+    """
+    Serialize operations as a Python literal, to be read by :func:`deserialize_log`.
+
+    Raises
+    ------
+    ValueError
+        If an argument can't be written as a literal, e.g. a function passed to
+        ``List.filter``.
+    """
+    entries = [tuple(operation) for operation in operations]
+    source = _render(get_ast_node_from_value(entries))
+    try:
+        get_value_from_ast_node(ast.parse(source, mode="eval").body)
+    except (ValueError, SyntaxError) as e:
+        raise ValueError(f"Operations can't be serialized: {e}") from None
+    return source
+
+
+def deserialize_log(source: str) -> "list[Operation]":
+    """Read operations written by :func:`serialize_log`."""
+    entries = get_value_from_ast_node(ast.parse(source, mode="eval").body)
+    return [Operation(*entry) for entry in entries]
+
+
+def compact_log(operations: Iterable[Operation]) -> "list[Operation]":
+    """
+    Drop and merge redundant operations, without changing the result of replaying them.
+
+    Operations on the same container are combined when they follow each other
+    (operations on other containers in between don't matter):
+
+    - anything followed by ``clear()`` is dropped;
+    - consecutive ``update``/``add`` calls and ``append``/``extend`` calls are merged;
+    - keys set by a dict ``update`` and then popped are dropped from the update;
+    - a set ``add`` followed by ``remove`` or ``discard`` of the value becomes a
+      ``discard``;
+    - an ``append`` directly undone by ``pop(-1)`` is dropped, along with the pop.
+    """
+    compacted = []
+    positions = {}  # (kind, name) -> indices in compacted of the operations on it
+    nested = False
+    for operation in operations:
+        if nested or "[" in operation.name:
+            # Operations on a nested container and on the containers holding it can't
+            # be moved past each other
+            nested = True
+            for target in _related_targets(positions, operation.name):
+                positions[target] = []
+        indices = positions.setdefault((operation.kind, operation.name), [])
+        if operation.method == "clear" and not (operation.args or operation.kwargs):
+            for i in indices:
+                compacted[i] = None
+            indices.clear()
+        elif indices:
+            merged = _merge_operations(compacted[indices[-1]], operation)
+            if merged is not None:
+                # Replace the previous operation with the merged ones
+                if merged:
+                    compacted[indices[-1]] = merged[0]
+                else:
+                    compacted[indices.pop()] = None
+                for extra in merged[1:]:
+                    indices.append(len(compacted))
+                    compacted.append(extra)
+                continue
+        indices.append(len(compacted))
+        compacted.append(operation)
+    return [operation for operation in compacted if operation is not None]
+
+
+def _related_targets(positions: dict, name: str) -> list:
+    """The targets in ``positions`` holding, or held by, the container ``name``."""
+    path = _split_path(name)
+    ancestors = {_path_name(path[0], path[1:i]) for i in range(1, len(path))}
+    return [
+        (kind, other)
+        for kind, other in positions
+        if other in ancestors or other.startswith(name + "[")
+    ]
+
+
+def _contains(values, value) -> bool:
+    try:
+        return value in values
+    except TypeError:
+        return False
+
+
+def _merge_operations(
+    previous: Operation, operation: Operation
+) -> Optional["list[Operation]"]:
+    """
+    Combine two consecutive operations on the same container.
+
+    Returns the operations replacing both, or None if they can't be combined.
+    """
+    method = operation.method
+    if previous.kind == "dict" and previous.method == "update":
+        if len(previous.args) > 1:
+            return None
+        values = dict(*previous.args, **previous.kwargs)
+        if method == "update" and len(operation.args) <= 1:
+            values.update(*operation.args, **operation.kwargs)
+            return [previous._replace(args=(values,), kwargs={})]
+        if method == "pop" and len(operation.args) == 1:
+            (key,) = operation.args
+            if _contains(values, key):
+                del values[key]
+                if not values:
+                    return [operation]
+                return [previous._replace(args=(values,), kwargs={}), operation]
+        return None
+
+    if previous.kwargs or operation.kwargs or len(operation.args) != 1:
+        return None
+    (arg,) = operation.args
+    if previous.kind == "set" and previous.method in ("add", "update"):
+        values = (
+            list(previous.args[0])
+            if previous.method == "update"
+            else [previous.args[0]]
+        )
+        if method in ("add", "update"):
+            values.extend([arg] if method == "add" else arg)
+            return [previous._replace(method="update", args=(values,))]
+        if method in ("remove", "discard") and _contains(values, arg):
+            values = [value for value in values if value != arg]
+            discard = operation._replace(method="discard")
+            if not values:
+                return [discard]
+            return [previous._replace(method="update", args=(values,)), discard]
+    if previous.kind == "list" and previous.method in ("append", "extend"):
+        values = (
+            list(previous.args[0])
+            if previous.method == "extend"
+            else [previous.args[0]]
+        )
+        if method in ("append", "extend"):
+            values.extend([arg] if method == "append" else arg)
+            return [previous._replace(method="extend", args=(values,))]
+        if method == "pop" and arg == -1 and values:
+            values.pop()
+            return (
+                [previous._replace(method="extend", args=(values,))] if values else []
+            )
+    return None
+
+
+class Profile:
+    """
+    Wall time spent in each phase of reading, editing and writing code, and related
+    counts.
+
+    Pass one to :class:`File` or :class:`Code` as ``profile``. The phases are "read",
+    "parse", "locate" (the "tokens" engine), "index", "lookup", "mutate", "render",
+    "format", "lock" (waiting for it) and "write". Phases may nest: e.g. the first
+    lookup includes indexing, and "write" includes rendering and formatting. Counts
+    include "bytes_read", "bytes_written", "nodes" (indexed), "cache_hits",
+    "cache_misses", "rereads" (of files changed by another process) and
+    "queued_edits" (applied together with ``queue=True``).
+    """
+
+    def __init__(self, name: Optional[str] = None):
+        """
+        Parameters
+        ----------
+        name: str, optional
+            Identifies what was profiled in exported data, e.g. the filename.
+        """
+        self.name = name
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.counts = collections.Counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time the body of a ``with`` block as part of the phase ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counts[name] += n
+
+    def to_dict(self) -> dict:
+        """Export as a flat dict, e.g. ``{"name": ..., "parse_seconds": ..., ...}``."""
+        data = {"name": self.name}
+        for phase in self.seconds:
+            data[f"{phase}_seconds"] = self.seconds[phase]
+            data[f"{phase}_calls"] = self.calls[phase]
+        data.update(self.counts)
+        return data
+
+    def to_json(self) -> str:
+        """Export as a single line of JSON, for appending to a JSON lines file."""
+        import json
+
+        return json.dumps(self.to_dict())
+
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+def _render(node: ast.AST) -> str:
+    """Render a node as source code, ending with a newline."""
+    # Raw lists are swapped for placeholder names while rendering, and their text is
+    # put in place of the names afterwards, so their elements are never parsed
+    if isinstance(node, _RawList) and node.text is not None:
+        return node.text + "\n"
+    raw = {}
+    stack = [node]
+    while stack:
+        parent = stack.pop()
+        for field, value in ast.iter_fields(parent):
+            children = value if isinstance(value, list) else [value]
+            for i, child in enumerate(children):
+                if isinstance(child, _RawList) and child.text is not None:
+                    placeholder = f"__code_crafter_raw_{len(raw)}__"
+                    raw[placeholder] = parent, field, i, child
+                    placeholder = ast.Name(id=placeholder, ctx=ast.Load())
+                    if isinstance(value, list):
+                        value[i] = placeholder
+                    else:
+                        setattr(parent, field, placeholder)
+                elif isinstance(child, ast.AST):
+                    stack.append(child)
+    try:
+        # black and astor are slow to import, so they are only imported when needed
+        if hasattr(ast, "unparse"):
+            text = ast.unparse(node) + "\n"
+        else:
+            import astor
+
+            text = astor.to_source(node)
+    finally:
+        for parent, field, i, child in raw.values():
+            value = getattr(parent, field)
+            if isinstance(value, list):
+                value[i] = child
+            else:
+                setattr(parent, field, child)
+    if raw:
+        pattern = "|".join(map(re.escape, raw))
+        text = re.sub(pattern, lambda match: raw[match.group()][3].text, text)
+    return text
+
+
+# Texts longer than this are whole files rather than single statements
+_FORMAT_CACHE_MAX_CHARS = 4096
+
+
+def _format_black(source_code: str, line_length: int = 88) -> str:
+    if len(source_code) > _FORMAT_CACHE_MAX_CHARS:
+        return _run_black(source_code, line_length)
+    return _run_black_cached(source_code, line_length)
+
+
+def _run_black(source_code: str, line_length: int) -> str:
+    import black
+
+    return black.format_str(source_code, mode=black.FileMode(line_length=line_length))
+
+
+# Statements are cached, since batch edits often render the same statement in many
+# files. Whole files are not, so the cache stays small in every batch worker.
+_run_black_cached = functools.lru_cache(maxsize=1024)(_run_black)
+
+
+_FORMATTERS = {"black": _format_black, "none": None}
+
+
+def _get_formatter(
+    formatter: Union[str, Callable[..., str], None],
+) -> Optional[Callable[..., str]]:
+    """Resolve a formatter name or callable to a callable, or None for no formatting."""
+    if formatter is None or callable(formatter):
+        return formatter
+    if formatter not in _FORMATTERS:
+        raise ValueError(f"Unknown formatter: {formatter!r}")
+    return _FORMATTERS[formatter]
+
+
+# In-place patches rewrite everything from the first change to the end of the file, so
+# they are only used when at most this many unchanged bytes follow the first change
+_PATCH_TAIL_BYTES = 64 * 1024
+
+
+@contextlib.contextmanager
+def _atomic_writer(
+    filename: str, mode: str = "w", fsync: bool = False, newline: Optional[str] = None
+):
+    """
+    Open a temporary file next to ``filename`` that replaces it when closed.
+
+    Readers see either the old or the new content, never a partial file. The file's
+    permissions are kept. On error the temporary file is removed and ``filename`` is
+    left untouched.
+    """
+    filename = os.path.realpath(filename)
+    directory = os.path.dirname(filename)
+    import tempfile
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        encoding = None if "b" in mode else "utf-8"
+        with os.fdopen(fd, mode, encoding=encoding, newline=newline) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        with contextlib.suppress(FileNotFoundError):
+            os.chmod(temp_path, os.stat(filename).st_mode & 0o7777)
+        os.replace(temp_path, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        raise
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        # Make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
 
 class File:
-    def __init__(self, filename: str, use_black: bool = True):
+    skipped_writes = 0
+    """Number of times a File was closed without changes, so writing it was skipped."""
+
+    def __init__(
+        self,
+        filename: str,
+        use_black: bool = True,
+        write_mode: Optional[str] = None,
+        cache: Optional["ParseCache"] = None,
+        engine: Optional[str] = None,
+        read_mode: str = "full",
+        fsync: bool = False,
+        formatter: Union[str, Callable[..., str], None] = "black",
+        profile: Union[bool, Profile, None] = None,
+        lock: bool = False,
+        queue: bool = False,
+        lock_dir: Optional[str] = None,
+    ):
         """
         Initialize the File object with the filename and whether to use the black code formatter.
 
@@ -37,28 +772,450 @@ class File:
         filename: str
             The filename of the Python file to read and write.
         use_black: bool, default=True
-            Whether to use the black code formatter to format the code.
+            Whether to format the code. False is the same as ``formatter=None``.
+        write_mode: {"full", "splice", "patch"}, optional
+            "full" regenerates and formats the whole file. "splice" re-renders only the
+            statements that were modified and splices them into the original text,
+            leaving the rest of the file (including comments) untouched. "patch" splices
+            too, but when the modified statements keep their length or are near the end
+            of the file, only the changed bytes are rewritten, in place. In-place
+            patches aren't atomic. Defaults to "full" for the "ast" engine and "splice"
+            for the "tokens" engine.
+
+            Other writes go to a temporary file that then replaces the original, so
+            readers never see a partially written file.
+        cache: ParseCache, optional
+            Cache to load the parsed file from, to avoid re-parsing files that are
+            opened repeatedly. Only used by the "ast" engine.
+        engine: {"ast", "tokens"}, optional
+            How the file is parsed, see :class:`Code`. The "tokens" engine only
+            supports the "splice" write mode. Defaults to "tokens" when memory-mapping
+            and "ast" otherwise.
+        read_mode: {"full", "mmap"}, default="full"
+            "full" reads the whole file into memory. "mmap" memory-maps it instead, only
+            parsing the statements that are looked up and copying the rest of the file
+            straight from the map when writing. Requires the "tokens" engine.
+        fsync: bool, default=False
+            Whether to flush writes to disk before returning.
+        formatter: {"black", "none"} or callable, default="black"
+            How to format the code that is written. A callable is called as
+            ``formatter(text, line_length=...)`` and returns the formatted text. In the
+            "splice" and "patch" write modes, only the modified statements are
+            formatted, so formatting time doesn't grow with the size of the file.
+        profile: bool or Profile, optional
+            Records the time spent in each phase of reading, editing and writing the
+            file. True creates a new :class:`Profile` named after the file.
+        lock: bool, default=False
+            Coordinate with other processes editing the file with ``lock=True``. The
+            file is read and written holding an advisory lock, and if it was changed
+            since it was read, it is read again and the operations recorded in
+            ``code.log`` are replayed onto it before writing, instead of overwriting
+            the other changes. Raises a RuntimeError if the
+            code was changed in ways that aren't recorded, e.g. by assigning ``tree``.
+            Requires ``fcntl``, so isn't available on Windows.
+        queue: bool, default=False
+            Like ``lock``, but instead of each process reading and writing the file in
+            turn, edits are added to a queue, and whichever process gets the lock
+            next applies all queued edits in a single read and write. Edits that
+            can't be applied raise an error in the process that made them.
+        lock_dir: str, optional
+            Directory for the lock and queue files, which are named after a hash of
+            the file's real path. Defaults to ``code_crafter-<uid>`` in the
+            temporary directory, which only its user can access. Every process
+            editing the file must use the same directory, so processes run by
+            several users need a shared one.
         """
+        if read_mode not in ("full", "mmap"):
+            raise ValueError(f"Unknown read_mode: {read_mode!r}")
+        if engine is None:
+            engine = "tokens" if read_mode == "mmap" else "ast"
+        if read_mode == "mmap" and engine != "tokens":
+            raise ValueError('read_mode="mmap" requires the "tokens" engine')
+        if write_mode is None:
+            write_mode = "splice" if engine == "tokens" else "full"
+        if write_mode not in ("full", "splice", "patch"):
+            raise ValueError(f"Unknown write_mode: {write_mode!r}")
+        if engine not in ("ast", "tokens"):
+            raise ValueError(f"Unknown engine: {engine!r}")
+        if engine == "tokens" and write_mode == "full":
+            raise ValueError('The "tokens" engine doesn\'t support write_mode="full"')
         self.filename = filename
         self.code = None
         self.use_black = use_black
+        self.formatter = _get_formatter(formatter) if use_black else None
+        self.write_mode = write_mode
+        self.cache = cache
+        self.engine = engine
+        self.read_mode = read_mode
+        self.fsync = fsync
+        self.profile = Profile(filename) if profile is True else profile or None
+        self.lock = lock or queue
+        self.queue = queue
+        self.lock_dir = lock_dir
+        self._mmap = None
+        self._newlines = None
+        self._stamp = None
 
     def __enter__(self):
+        if self.lock:
+            with self._locked(exclusive=False):
+                self._read()
+        else:
+            self._read()
+        return self
+
+    def _read(self) -> None:
         # Read the file and parse its content into an AST
-        with open(self.filename, "r") as f:
+        if self.cache is not None and self.engine == "ast":
+            misses = self.cache.misses
+            with self._phase("read"):
+                self.code = self.cache.load(self.filename)
+            self.code.profile = self.profile
+            self._count("cache_misses" if self.cache.misses > misses else "cache_hits")
+            return
+        if self.read_mode == "mmap":
+            with self._phase("read"), open(self.filename, "rb") as f:
+                stat = os.fstat(f.fileno())
+                self._stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                if stat.st_size:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.code = Code(
+                b"" if self._mmap is None else self._mmap,
+                engine=self.engine,
+                profile=self.profile,
+            )
+            return
+        # Python source files are UTF-8, whatever the locale
+        with self._phase("read"), open(self.filename, "r", encoding="utf-8") as f:
             source_code = f.read()
-        self.code = Code(source_code)
-        return self
+            self._newlines = f.newlines
+            self._count("bytes_read", os.fstat(f.fileno()).st_size)
+        self.code = self._parse(source_code)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        # When exiting the with block, write back the modified AST to the file
-        source_code = astor.to_source(self.code.tree)
+    def _parse(self, source_code: str) -> "Code":
+        return Code(source_code, engine=self.engine, profile=self.profile)
 
-        if self.use_black:
-            source_code = black.format_str(source_code, mode=black.FileMode())
+    def _phase(self, name: str):
+        return _NO_PHASE if self.profile is None else self.profile.phase(name)
+
+    def _count(self, name: str, n: int = 1) -> None:
+        if self.profile is not None:
+            self.profile.count(name, n)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self.queue and self.code.modified:
+                self._write_queued()
+            elif self.lock and self.code.modified:
+                with self._locked(exclusive=True):
+                    if self._changed_on_disk():
+                        (error,) = self._reread([self.code.log])
+                        if error is not None:
+                            raise error
+                    with self._phase("write"):
+                        self._write()
+            else:
+                with self._phase("write"):
+                    self._write()
+        finally:
+            self._close_map()
+
+    def _close_map(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _sidecar(self, suffix: str) -> str:
+        """The path of a lock or queue file, kept out of the file's directory."""
+        import stat
+        import tempfile
+
+        lock_dir = self.lock_dir
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+        else:
+            # Private to the user, so that nobody else can plant files or symlinks
+            lock_dir = os.path.join(
+                tempfile.gettempdir(), f"code_crafter-{os.getuid()}"
+            )
+            os.makedirs(lock_dir, mode=0o700, exist_ok=True)
+            info = os.lstat(lock_dir)
+            if (
+                not stat.S_ISDIR(info.st_mode)
+                or info.st_uid != os.getuid()
+                or info.st_mode & 0o077
+            ):
+                raise PermissionError(
+                    f"{lock_dir} must be a directory only accessible by its owner"
+                )
+        # Named after the real path, so that every link to the file shares it
+        key = hashlib.sha256(os.path.realpath(self.filename).encode()).hexdigest()
+        return os.path.join(lock_dir, key + suffix)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive: bool):
+        """Hold the advisory lock shared by every process editing the file."""
+        import fcntl
+
+        # The file itself is replaced when writing, so the lock is on a sidecar file
+        fd = os.open(self._sidecar(".lock"), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            with self._phase("lock"):
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def _changed_on_disk(self) -> bool:
+        """Whether the file's content differs from what was read."""
+        if self.read_mode == "mmap":
+            stat = os.stat(self.filename)
+            return self._stamp != (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        # Modification times can be too coarse to tell writes apart, so compare content
+        with open(self.filename, "r", encoding="utf-8") as f:
+            return f.read() != self.code.source
+
+    def _reread(self, logs: "list[list[Operation]]") -> "list[Optional[Exception]]":
+        """
+        Read the file again and replay each of ``logs`` onto it.
 
-        with open(self.filename, "w") as f:
+        Logs that fail to apply are left out. Returns the error of each log, or None
+        for those that were applied.
+        """
+        if None in self.code._modified or (self.code.modified and not self.code.log):
+            raise RuntimeError(
+                f"{self.filename} was changed since it was read, and the changes made "
+                "to its code weren't recorded, so they can't be applied again"
+            )
+        self._count("rereads")
+        errors = [None] * len(logs)
+        applied = []
+        self._close_map()
+        self._read()
+        for i, log in enumerate(logs):
+            try:
+                self.code.replay(log)
+            except Exception as e:
+                errors[i] = e
+                # Start over, since the failed log may have been partially applied
+                self._read()
+                for good in applied:
+                    self.code.replay(good)
+            else:
+                applied.append(log)
+        return errors
+
+    def _write_queued(self) -> None:
+        """Add the edits to the queue, and apply the queue unless another process did."""
+        import fcntl
+        import json
+
+        if None in self.code._modified or not self.code.log:
+            raise RuntimeError(
+                f"Can't queue the changes to {self.filename}, since changes made to "
+                "its code without the container wrappers aren't recorded"
+            )
+        record_id = os.urandom(8).hex()
+        record = {"id": record_id, "operations": serialize_log(self.code.log)}
+        with open(self._sidecar(".queue"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + "\n")
+
+        with self._locked(exclusive=True):
+            with open(self._sidecar(".queue"), "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                records = [json.loads(line) for line in f.read().splitlines()]
+            queued = any(record["id"] == record_id for record in records)
+            if not records:
+                # Another process wrote our edits, or failed to
+                self._raise_queued_error(record_id)
+                return
+            self._count("queued_edits", len(records))
+            try:
+                errors = self._apply_queued(records, record_id)
+            except BaseException:
+                # The other records stay queued, for their processes to apply
+                self._unqueue({record_id})
+                raise
+            self._unqueue({record["id"] for record in records})
+
+            # Report errors to the processes that queued the edits
+            own_error = None
+            entries = []
+            for record, error in zip(records, errors):
+                if record["id"] == record_id:
+                    own_error = error
+                elif error is not None:
+                    error = [type(error).__name__, str(error)]
+                    entries.append(json.dumps({"id": record["id"], "error": error}))
+            if entries:
+                with open(self._sidecar(".queue-errors"), "a") as f:
+                    f.write("\n".join(entries) + "\n")
+            if own_error is not None:
+                raise own_error
+            if not queued:
+                self._raise_queued_error(record_id)
+
+    def _apply_queued(
+        self, records: "list[dict]", record_id: str
+    ) -> "list[Optional[Exception]]":
+        """Apply the queued records and write the file. Returns each record's error."""
+        queued = any(record["id"] == record_id for record in records)
+        errors = [None] * len(records)
+        # Our tree can be written as it is if it only holds our edits, which are
+        # the only ones queued
+        if not queued or len(records) > 1 or self._changed_on_disk():
+            logs = []
+            for i, record in enumerate(records):
+                if record["id"] == record_id:
+                    logs.append(self.code.log)
+                    continue
+                try:
+                    logs.append(deserialize_log(record["operations"]))
+                except Exception as e:
+                    errors[i] = e
+                    logs.append([])
+            replay_errors = self._reread(logs)
+            errors = [error or other for error, other in zip(errors, replay_errors)]
+        with self._phase("write"):
+            self._write()
+        return errors
+
+    def _unqueue(self, record_ids: set) -> None:
+        """Remove records from the queue, keeping any queued since it was read."""
+        import fcntl
+        import json
+
+        with open(self._sidecar(".queue"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            lines = f.read().splitlines()
+            f.truncate(0)
+            f.writelines(
+                line + "\n"
+                for line in lines
+                if json.loads(line)["id"] not in record_ids
+            )
+
+    def _raise_queued_error(self, record_id: str) -> None:
+        """Raise the error of a queued record that another process failed to apply."""
+        import json
+
+        path = self._sidecar(".queue-errors")
+        try:
+            with open(path, "r") as f:
+                entries = [json.loads(line) for line in f.read().splitlines()]
+        except FileNotFoundError:
+            return
+        mine = [entry for entry in entries if entry["id"] == record_id]
+        if not mine:
+            return
+        with open(path, "w") as f:
+            for entry in entries:
+                if entry["id"] != record_id:
+                    f.write(json.dumps(entry) + "\n")
+        raise _error_from(*mine[0]["error"])
+
+    def _write(self):
+        # When exiting the with block, write back the modified AST to the file
+        if not self.code.modified:
+            File.skipped_writes += 1
+            return
+
+        formatter = self.formatter
+        if self.write_mode == "patch" and self._patch(formatter):
+            return
+
+        if self.read_mode == "mmap":
+            # Stream the unchanged parts straight from the map
+            with _atomic_writer(self.filename, "wb", self.fsync) as f:
+                if not self.code.splice_to(f, formatter=formatter):
+                    f.write(self._render_full().encode("utf-8"))
+                self._count("bytes_written", f.tell())
+                # Windows can't replace a file that is still mapped
+                self._close_map()
+            return
+
+        source_code = None
+        if self.write_mode in ("splice", "patch"):
+            source_code = self.code.splice(formatter=formatter)
+        if source_code is None:
+            source_code = self._render_full()
+
+        # Keep the file's line endings. Files mixing several are written with "\n"
+        newline = self._newlines if isinstance(self._newlines, str) else None
+        with _atomic_writer(self.filename, "w", self.fsync, newline) as f:
             f.write(source_code)
+        self._count("bytes_written", os.stat(self.filename).st_size)
+
+    def _render_full(self) -> str:
+        with self._phase("render"):
+            source_code = _render(self.code.tree)
+        if self.formatter is not None:
+            with self._phase("format"):
+                source_code = self.formatter(source_code, line_length=88)
+        return source_code
+
+    def _patch(self, formatter: Optional[Callable[..., str]]) -> bool:
+        """Rewrite only the changed bytes of the file in place, if that's possible."""
+        if self._newlines not in (None, "\n"):
+            # Offsets in the source don't match offsets in the file
+            return False
+        chunks = self.code._splice_chunks(formatter)
+        if chunks is None:
+            return False
+
+        source = self.code.source
+        if isinstance(source, str) and not source.isascii():
+
+            def to_bytes(offset):
+                return len(source[:offset].encode("utf-8"))
+
+        else:
+
+            def to_bytes(offset):
+                return offset
+
+        # (start, end, new bytes) of each replaced range, in file offsets
+        replacements = []
+        for i in range(1, len(chunks), 2):
+            text = chunks[i]
+            if isinstance(text, str):
+                text = text.encode("utf-8")
+            start, end = to_bytes(chunks[i - 1][1]), to_bytes(chunks[i + 1][0])
+            replacements.append((start, end, text))
+        if not replacements:
+            return False
+
+        with open(self.filename, "r+b") as f:
+            if all(end - start == len(text) for start, end, text in replacements):
+                for start, end, text in replacements:
+                    f.seek(start)
+                    f.write(text)
+                    self._count("bytes_written", len(text))
+            else:
+                # Everything after the first change moves, so rewrite it all
+                starts = [start for start, _, _ in replacements[1:]]
+                starts.append(os.fstat(f.fileno()).st_size)
+                unchanged = [
+                    (end, stop) for (_, end, _), stop in zip(replacements, starts)
+                ]
+                if sum(stop - end for end, stop in unchanged) > _PATCH_TAIL_BYTES:
+                    return False
+                pieces = []
+                for (_, _, text), (end, stop) in zip(replacements, unchanged):
+                    f.seek(end)
+                    pieces.append(text)
+                    pieces.append(f.read(stop - end))
+                f.seek(replacements[0][0])
+                self._count("bytes_written", f.write(b"".join(pieces)))
+                f.truncate()
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return True
 
     def find_dict(self, name: str) -> "Dict":
         return self.code.find_dict(name)
@@ -69,39 +1226,725 @@ class File:
     def find_set(self, name: str) -> "Set":
         return self.code.find_set(name)
 
+    def load(self, name: str) -> Any:
+        return self.code.load(name)
+
+    def at(self, name: str, *keys: Any) -> Union["Dict", "List", "Set"]:
+        return self.code.at(name, *keys)
+
+    def replay(self, operations: Iterable["Operation"], strict: bool = True) -> int:
+        return self.code.replay(operations, strict=strict)
+
+
+def _run_in(executor, func: Callable, *args, **kwargs) -> Any:
+    return executor.submit(func, *args, **kwargs).result()
+
+
+class AsyncFile(File):
+    """
+    A :class:`File` for ``async with``, for editing files from asyncio code.
+
+    Reading and writing the file run in the event loop's default executor, so they
+    don't block the loop.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        *args,
+        executor: Optional["concurrent.futures.Executor"] = None,
+        **kwargs,
+    ):
+        """
+        Parameters
+        ----------
+        filename: str
+            The filename of the Python file to read and write.
+        executor: concurrent.futures.Executor, optional
+            Executor to parse and format the code in, e.g. a process pool so that this
+            CPU-bound work runs in parallel. The formatter must then be picklable.
+            Defaults to doing it in the same thread as the I/O. Don't pass the loop's
+            default executor, since the I/O threads wait on it.
+        *args, **kwargs
+            Passed on to :class:`File`.
+        """
+        super().__init__(filename, *args, **kwargs)
+        self.executor = executor
+        if executor is not None and self.formatter is not None:
+            self.formatter = functools.partial(_run_in, executor, self.formatter)
+
+    def _parse(self, source_code: str) -> "Code":
+        if self.executor is None or self.engine != "ast":
+            code = super()._parse(source_code)
+        else:
+            with self._phase("parse"):
+                tree = _run_in(self.executor, ast.parse, source_code)
+            code = Code(
+                source_code, tree=tree, engine=self.engine, profile=self.profile
+            )
+        if code._tree is not None:
+            # Index the names here rather than on the event loop in the first find_*
+            code._index = code._build_index()
+        return code
+
+    async def __aenter__(self):
+        import asyncio
+
+        await asyncio.get_running_loop().run_in_executor(None, self.__enter__)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        import asyncio
+
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.__exit__, exc_type, exc_val, exc_tb
+        )
+
+
+class ParseCache:
+    """
+    An LRU cache of parsed files.
+
+    Entries are keyed by absolute path and validated against the file's modification
+    time and size (or a hash of its contents). Every load returns a new
+    :class:`Code` with its own copy of the tree, so edits never leak into the cache.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = 128,
+        max_bytes: Optional[int] = None,
+        directory: Optional[str] = None,
+        hash_contents: bool = False,
+    ):
+        """
+        Parameters
+        ----------
+        max_entries: int, optional
+            Maximum number of files kept in memory. None for no limit.
+        max_bytes: int, optional
+            Maximum total size of the cached sources and trees, in bytes. None for no
+            limit.
+        directory: str, optional
+            Directory in which to persist parsed trees as pickles, so they can be reused
+            by later processes. Only point this at a directory you trust.
+        hash_contents: bool, default=False
+            Validate entries with a hash of the file contents instead of its
+            modification time and size. The file is still read, but not re-parsed.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self, filename: str) -> "Code":
+        """Return a Code object for ``filename``, parsing it only if it is not cached."""
+        path = os.path.abspath(filename)
+        source_code = None
+        if self.hash_contents:
+            with open(path, "r", encoding="utf-8") as f:
+                source_code = f.read()
+            stamp = hashlib.sha256(source_code.encode("utf-8")).hexdigest()
+        else:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            self._entries.move_to_end(path)
+            self.hits += 1
+        else:
+            entry = self._load_from_disk(path, stamp)
+            if entry is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                if source_code is None:
+                    with open(path, "r", encoding="utf-8") as f:
+                        source_code = f.read()
+                tree = ast.parse(source_code)
+                entry = (
+                    stamp,
+                    source_code,
+                    pickle.dumps(tree, pickle.HIGHEST_PROTOCOL),
+                )
+                self._save_to_disk(path, entry)
+            self._store(path, entry)
+
+        _, source_code, data = entry
+        return Code(source_code, tree=pickle.loads(data))
+
+    def stats(self) -> dict:
+        """Return hit/miss counts and the current size of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    def clear(self) -> None:
+        """Drop all in-memory entries. Pickles on disk are kept."""
+        self._entries.clear()
+        self._bytes = 0
+
+    @staticmethod
+    def _entry_size(entry: tuple) -> int:
+        return len(entry[1]) + len(entry[2])
+
+    def _store(self, path: str, entry: tuple) -> None:
+        old = self._entries.pop(path, None)
+        if old is not None:
+            self._bytes -= self._entry_size(old)
+        self._entries[path] = entry
+        self._bytes += self._entry_size(entry)
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._entry_size(evicted)
+
+    def _disk_path(self, path: str, stamp: Any) -> str:
+        # Pickled trees are only valid for the Python version that produced them
+        key = repr((path, stamp, sys.version_info[:2])).encode("utf-8")
+        return os.path.join(self.directory, hashlib.sha256(key).hexdigest() + ".pickle")
+
+    def _load_from_disk(self, path: str, stamp: Any) -> Optional[tuple]:
+        if self.directory is None:
+            return None
+        try:
+            with open(self._disk_path(path, stamp), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _save_to_disk(self, path: str, entry: tuple) -> None:
+        if self.directory is None:
+            return
+        import tempfile
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._disk_path(path, entry[0]))
+
+
+# The start of a line that may begin a top-level statement: not indented, blank, a
+# comment or a closing bracket
+_STATEMENT_START = re.compile(r"^(?=[^\s#)\]}])", re.MULTILINE)
+_STATEMENT_START_BYTES = re.compile(rb"^(?=[^\s#)\]}])", re.MULTILINE)
+_MAX_STATEMENT_ATTEMPTS = 64
+
+# Any string literal (with any prefix, triple-quoted or not) or comment, so that the
+# assignments searched for are only matched outside of them. The loops are unrolled
+# so that unterminated strings don't backtrack exponentially.
+_STRING_OR_COMMENT = (
+    r"[rRbBuUfF]{0,2}(?:"
+    r"'''[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*'''"
+    r'|"""[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*"""'
+    r"|'[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*'"
+    r'|"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"'
+    r")|#[^\n]*"
+)
+
+
+def _locate_assignments(
+    source: Union[str, bytes, mmap.mmap], name: str
+) -> Iterator[Tuple[ast.Assign, int, int]]:
+    """
+    Find top-level ``name = ...`` statements without parsing the whole source.
+
+    Candidates are found with a regular expression that skips over strings and
+    comments. Each one is parsed on its own,
+    extending the parsed text to the next line that may start a statement until it
+    parses. Yields the statement (with positions relative to its start) and its start
+    and end offsets in ``source``. ``source`` may also be a bytes-like buffer such as
+    an mmap, in which case the offsets are byte offsets.
+    """
+    pattern = rf"{_STRING_OR_COMMENT}|(?P<name>^{re.escape(name)}[ \t]*=(?!=))"
+    if isinstance(source, str):
+        pattern = re.compile(pattern, re.MULTILINE)
+        statement_start, newline = _STATEMENT_START, "\n"
+    else:
+        pattern = re.compile(pattern.encode(), re.MULTILINE)
+        statement_start, newline = _STATEMENT_START_BYTES, b"\n"
+
+    for match in pattern.finditer(source):
+        if match.lastgroup != "name":
+            continue
+
+        start = match.start()
+        boundary = statement_start.search(
+            source, source.find(newline, start) + 1 or len(source)
+        )
+        for _ in range(_MAX_STATEMENT_ATTEMPTS):
+            end = boundary.start() if boundary else len(source)
+            try:
+                module = ast.parse(source[start:end])
+            except SyntaxError:
+                if boundary is None:
+                    break
+                boundary = statement_start.search(source, end + 1)
+                continue
+            stmt = module.body[0]
+            if _assigned_name(stmt) == name:
+                snippet = Code(source[start:end], tree=module)
+                stmt_end = start + snippet._offset(stmt.end_lineno, stmt.end_col_offset)
+                yield stmt, start, stmt_end
+            break
+
+
+def _assigned_name(node: ast.AST) -> Optional[str]:
+    """The name assigned to by ``node`` if it is an assignment to a plain name."""
+    if isinstance(node, ast.Assign):
+        target = node.targets[0]
+    elif isinstance(node, ast.AnnAssign) and node.value is not None:
+        target = node.target
+    else:
+        return None
+    return target.id if isinstance(target, ast.Name) else None
+
+
+def _target_name(target: ast.expr) -> Optional[str]:
+    """The dotted name assigned to by ``target``, or None if it isn't a (dotted) name."""
+    if isinstance(target, ast.Name):
+        return target.id
+    if isinstance(target, ast.Attribute):
+        owner = _target_name(target.value)
+        return None if owner is None else f"{owner}.{target.attr}"
+    return None
+
+
+# Nodes that may contain statements
+_COMPOUND_PARTS = (ast.stmt, ast.excepthandler) + (
+    (ast.match_case,) if hasattr(ast, "match_case") else ()
+)
+
+
+def _assignment_targets(
+    tree: ast.AST,
+) -> Iterator[Tuple[str, ast.expr, ast.stmt]]:
+    """
+    Yield ``(qualified name, value, statement)`` for each assignment in ``tree``, in
+    source order. Tuple and list targets are paired up with the elements of tuple and
+    list values.
+    """
+    stack = [((), iter(ast.iter_child_nodes(tree)))]
+    while stack:
+        scope, children = stack[-1]
+        node = next(children, None)
+        if node is None:
+            stack.pop()
+            continue
+        if isinstance(node, (ast.Assign, ast.AnnAssign)) and node.value is not None:
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            pairs = [(target, node.value) for target in targets]
+            while pairs:
+                target, value = pairs.pop(0)
+                if isinstance(target, (ast.Tuple, ast.List)):
+                    if isinstance(value, (ast.Tuple, ast.List)) and len(
+                        value.elts
+                    ) == len(target.elts):
+                        pairs[:0] = zip(target.elts, value.elts)
+                    continue
+                name = _target_name(target)
+                if name is not None:
+                    yield ".".join(scope + (name,)), value, node
+        elif isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            stack.append((scope + (node.name,), iter(node.body)))
+        elif isinstance(node, _COMPOUND_PARTS):
+            stack.append((scope, iter(ast.iter_child_nodes(node))))
+
+
+class BatchResult(NamedTuple):
+    """The outcome of editing one file with :func:`batch`."""
+
+    path: str
+    result: Any = None
+    error: Optional[str] = None
+    profile: Optional[dict] = None
+    """The file's :class:`Profile` as a dict, when editing with ``profile=True``."""
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _edit_files(paths: list, edit: Callable, file_kwargs: dict) -> list:
+    results = []
+    for path in paths:
+        try:
+            file = File(path, **file_kwargs).__enter__()
+            result = edit(file)
+            # Only write the file back if the edit succeeded
+            file.__exit__(None, None, None)
+        except Exception:
+            results.append(BatchResult(path, error=traceback.format_exc()))
+        else:
+            profile = file.profile.to_dict() if file.profile is not None else None
+            results.append(BatchResult(path, result=result, profile=profile))
+    return results
+
+
+def batch(
+    paths: Iterable[str],
+    edit: Callable[[File], Any],
+    max_workers: Optional[int] = None,
+    chunksize: int = 1,
+    **file_kwargs,
+) -> "list[BatchResult]":
+    """
+    Apply ``edit`` to many files in parallel worker processes.
+
+    Each path is opened as a :class:`File` (with ``file_kwargs``), passed to ``edit``,
+    and written back if ``edit`` returns without raising. Errors are collected per
+    file instead of stopping the batch.
+
+    Parameters
+    ----------
+    paths: iterable of str
+        The files to edit.
+    edit: callable
+        Called with each open File. It must be picklable, e.g. a module-level
+        function, and so must its return value.
+    max_workers: int, optional
+        Number of worker processes. Defaults to the number of CPUs. With 1, files
+        are edited serially in the current process.
+    chunksize: int, default=1
+        Number of files sent to a worker at a time.
+    **file_kwargs
+        Passed on to :class:`File`, e.g. ``use_black`` or ``write_mode``.
+
+    Returns
+    -------
+    list of BatchResult
+        One result per path, in the order of ``paths``.
+    """
+    paths = list(paths)
+    if max_workers == 1:
+        return _edit_files(paths, edit, file_kwargs)
+
+    import concurrent.futures
+
+    chunks = [paths[i : i + chunksize] for i in range(0, len(paths), chunksize)]
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_edit_files, chunk, edit, file_kwargs) for chunk in chunks
+        ]
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.extend(future.result())
+            except Exception:
+                error = traceback.format_exc()
+                results.extend(BatchResult(path, error=error) for path in chunk)
+    return results
+
+
+async def async_batch(
+    paths: Iterable[str],
+    edit: Callable[[AsyncFile], Any],
+    max_concurrency: Optional[int] = None,
+    **file_kwargs,
+) -> "list[BatchResult]":
+    """
+    Apply ``edit`` to many files concurrently from asyncio code.
+
+    Each path is opened as an :class:`AsyncFile` (with ``file_kwargs``), passed to
+    ``edit``, and written back if ``edit`` returns without raising. Errors are
+    collected per file instead of stopping the batch.
+
+    Parameters
+    ----------
+    paths: iterable of str
+        The files to edit.
+    edit: callable
+        Called with each open AsyncFile. May be a coroutine function.
+    max_concurrency: int, optional
+        Maximum number of files open at a time. Defaults to twice the number of CPUs.
+        Parsing and formatting in threads competes with the event loop for the GIL,
+        so higher values mostly help when reading and writing is slow.
+    **file_kwargs
+        Passed on to :class:`AsyncFile`, e.g. ``executor`` or ``write_mode``.
+
+    Returns
+    -------
+    list of BatchResult
+        One result per path, in the order of ``paths``.
+    """
+    import asyncio
+    import inspect
+
+    if max_concurrency is None:
+        max_concurrency = 2 * (os.cpu_count() or 1)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def edit_file(path):
+        async with semaphore:
+            try:
+                file = await AsyncFile(path, **file_kwargs).__aenter__()
+                result = edit(file)
+                if inspect.isawaitable(result):
+                    result = await result
+                # Only write the file back if the edit succeeded
+                await file.__aexit__(None, None, None)
+            except Exception:
+                return BatchResult(path, error=traceback.format_exc())
+            profile = file.profile.to_dict() if file.profile is not None else None
+            return BatchResult(path, result=result, profile=profile)
+
+    return list(await asyncio.gather(*(edit_file(path) for path in paths)))
+
 
 class Code:
     """Represents a Python source code document for AST manipulation."""
 
-    def __init__(self, source_code: str):
-        self.tree = ast.parse(source_code)
+    def __init__(
+        self,
+        source_code: Union[str, bytes, mmap.mmap],
+        tree: Optional[ast.Module] = None,
+        engine: str = "ast",
+        profile: Optional[Profile] = None,
+    ):
+        """
+        Parameters
+        ----------
+        source_code: str or bytes-like
+            The Python source code. May also be encoded, e.g. a memory-mapped file, in
+            which case positions in it are byte offsets.
+        tree: ast.Module, optional
+            An already parsed tree for ``source_code``. Parsed from the source if omitted.
+        engine: {"ast", "tokens"}, default="ast"
+            "ast" parses the whole source up front. "tokens" only parses the top-level
+            statements that are looked up, which is much faster for large files. It
+            falls back to parsing the whole source for names that aren't assigned at
+            the top level. Changes made with the "tokens" engine are only rendered by
+            ``splice()``.
+        profile: Profile, optional
+            Records the time spent parsing, looking up, modifying and rendering code.
+        """
+        if engine not in ("ast", "tokens"):
+            raise ValueError(f"Unknown engine: {engine!r}")
+        self.source = source_code
+        self.engine = engine
+        self.profile = profile
+        self._modified = {}
+        # Operations applied to the containers found in this code
+        self.log = []
+        self._line_starts = None
+        self._spans = {}
+        self._located = {}
+        self._tree = None
+        self._index = None
+        # Wrappers returned by at(), as a tree of [wrapper, {key: [wrapper, ...]}]
+        self._paths = {}
+        if tree is not None or engine == "ast":
+            if tree is None:
+                with self._phase("parse"):
+                    tree = ast.parse(source_code)
+            self.tree = tree
+
+    @property
+    def tree(self) -> ast.Module:
+        if self._tree is None:
+            source = self.source
+            if not isinstance(source, (str, bytes)):
+                source = source[:]
+            with self._phase("parse"):
+                self._tree = ast.parse(source)
+            if self._located:
+                # "tokens" engine: statements located (and maybe edited) before the
+                # whole source was parsed take the place of their copies
+                located = {
+                    self._spans[id(stmt)][0]: stmt
+                    for stmts in self._located.values()
+                    for stmt in stmts
+                }
+                body = self._tree.body
+                for i, stmt in enumerate(body):
+                    start = self._offset(stmt.lineno, stmt.col_offset)
+                    body[i] = located.get(start, stmt)
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree: ast.Module) -> None:
+        if self._tree is not None:
+            self._mark_modified(None)
+        self._tree = tree
+        self._index = None
+        self._paths.clear()
+
+    @property
+    def modified(self) -> bool:
+        """Whether the tree has been changed since it was parsed."""
+        return bool(self._modified)
+
+    def invalidate_index(self) -> None:
+        """
+        Drop the cached name index and mark the tree as modified.
+
+        Call this after adding or removing assignments by editing ``tree`` directly.
+        Assigning a new tree to ``tree`` does this automatically.
+        """
+        if self._located:
+            # Parse the tree first, so it holds the statements edited so far
+            self.tree
+        self._index = None
+        self._located.clear()
+        self._paths.clear()
+        self._mark_modified(None)
+
+    def _build_index(self) -> dict:
+        """Map each assigned name to its assignment statements, in ``ast.walk`` order."""
+        index = {}
+        nodes = 0
+        with self._phase("index"):
+            for node in ast.walk(self.tree):
+                nodes += 1
+                name = _assigned_name(node)
+                if name is not None:
+                    index.setdefault(name, []).append(node)
+        if self.profile is not None:
+            self.profile.count("nodes", nodes)
+        return index
+
+    def _phase(self, name: str):
+        """Context manager timing a phase in ``profile``, if there is one."""
+        return _NO_PHASE if self.profile is None else self.profile.phase(name)
+
+    def _assignments(self, name: str) -> Iterator[ast.stmt]:
+        """Iterate over the assignment statements assigning to ``name``."""
+        if self._tree is None and name not in self._located:
+            # "tokens" engine: try the top-level statements before parsing everything
+            located = []
+            with self._phase("locate"):
+                for stmt, start, end in _locate_assignments(self.source, name):
+                    self._spans[id(stmt)] = (start, end)
+                    located.append(stmt)
+            self._located[name] = located
+        # Located statements come first, and are also in the tree once it's parsed
+        located = self._located.get(name, ())
+        yield from located
+        if self._index is None:
+            self._index = self._build_index()
+        located = {id(stmt) for stmt in located}
+        for stmt in self._index.get(name, ()):
+            if id(stmt) not in located:
+                yield stmt
+
+    def _wrap(
+        self, value: ast.expr, stmt: ast.stmt, name: str
+    ) -> Union["Dict", "List", "Set", None]:
+        """Wrap ``value``, assigned to ``name`` in ``stmt``, if it is a dict, list or set."""
+        # Check for dict/list/set function calls
+        if isinstance(value, ast.Call):
+            func_id = getattr(value.func, "id", None)
+            if func_id == "dict":
+                return FunctionCallDict(value, code=self, stmt=stmt, name=name)
+            if func_id == "list":
+                return FunctionCallList(value, code=self, stmt=stmt, name=name)
+            if func_id == "set":
+                return FunctionCallSet(value, code=self, stmt=stmt, name=name)
+            return None
+
+        # Literals wrap the assignment when they are its whole value
+        node = stmt if getattr(stmt, "value", None) is value else value
+        if isinstance(value, ast.Dict):
+            return LiteralDict(node, code=self, stmt=stmt, name=name)
+        if isinstance(value, ast.List):
+            return LiteralList(node, code=self, stmt=stmt, name=name)
+        if isinstance(value, ast.Set):
+            return LiteralSet(node, code=self, stmt=stmt, name=name)
+        return None
 
     def _find_node(
         self, name: str, node_cls: Type[Union["Dict", "List", "Set"]]
     ) -> Union["Dict", "List", "Set", None]:
         """Generic method to find and return a specific type of node."""
-        for node in ast.walk(self.tree):
-            if (
-                isinstance(node, ast.Assign)
-                and isinstance(node.targets[0], ast.Name)
-                and node.targets[0].id == name
-            ):
-                # Check for dict/list/set function calls
-                if isinstance(node.value, ast.Call):
-                    if node.value.func.id == "dict" and node_cls == Dict:
-                        return FunctionCallDict(node.value)
-                    if node.value.func.id == "list" and node_cls == List:
-                        return FunctionCallList(node.value)
-                    if node.value.func.id == "set" and node_cls == Set:
-                        return FunctionCallSet(node.value)
-
-                # Existing checks for literals
-                elif isinstance(node.value, ast.Dict) and node_cls == Dict:
-                    return LiteralDict(node)
-                elif isinstance(node.value, ast.List) and node_cls == List:
-                    return LiteralList(node)
-                elif isinstance(node.value, ast.Set) and node_cls == Set:
-                    return LiteralSet(node)
+        with self._phase("lookup"):
+            for node in self._assignments(name):
+                if _assigned_name(node) != name:
+                    # The target was renamed after the index was built
+                    continue
+                wrapper = self._wrap(node.value, node, name)
+                if isinstance(wrapper, node_cls):
+                    return wrapper
+
+    def find_all(
+        self,
+        names: Union[str, "re.Pattern", Iterable[Union[str, "re.Pattern"]]] = "*",
+        kinds: Optional[Iterable[Union[str, type]]] = None,
+        scope: Optional[str] = None,
+    ) -> dict:
+        """
+        Find every dict, list and set assigned to a matching name, in one pass.
+
+        Each assignment target has a qualified name: the names of the enclosing classes
+        and functions and the target itself, joined by dots, e.g. ``"registry"``,
+        ``"MyClass.registry"`` or ``"MyClass.__init__.self.items"``. Annotated
+        assignments, attribute targets and unpacking into tuples are included.
+
+        Parameters
+        ----------
+        names: str, re.Pattern or iterable of them, default="*"
+            Qualified names to look for. Strings are glob patterns (so plain names
+            match only themselves) and compiled regular expressions must match the
+            whole name.
+        kinds: iterable of {"dict", "list", "set"}, optional
+            The kinds of containers to return, also given as the classes
+            :class:`Dict`, :class:`List` or :class:`Set`. Defaults to all of them.
+        scope: str, optional
+            Qualified name of a class or function to search in. Names are then matched,
+            and returned, relative to it.
+
+        Returns
+        -------
+        dict
+            Maps each matching qualified name to a wrapper of its first assignment, in
+            source order.
+        """
+        if isinstance(names, (str, re.Pattern)):
+            names = [names]
+        exact = set()
+        patterns = []
+        for name in names:
+            if isinstance(name, re.Pattern):
+                patterns.append(name)
+            elif any(char in name for char in "*?["):
+                patterns.append(re.compile(fnmatch.translate(name)))
+            else:
+                exact.add(name)
+        kinds = tuple(
+            {"dict": Dict, "list": List, "set": Set}.get(kind, kind)
+            for kind in (kinds or ("dict", "list", "set"))
+        )
+        prefix = "" if scope is None else scope + "."
+
+        found = {}
+        with self._phase("lookup"):
+            for name, value, stmt in _assignment_targets(self.tree):
+                if not name.startswith(prefix):
+                    continue
+                name = name[len(prefix) :]
+                if name in found or not (
+                    name in exact
+                    or any(pattern.fullmatch(name) for pattern in patterns)
+                ):
+                    continue
+                # Logged under the qualified name, so replay finds the same container
+                wrapper = self._wrap(value, stmt, prefix + name)
+                if isinstance(wrapper, kinds):
+                    found[name] = wrapper
+        return found
 
     def find_dict(self, name: str) -> "Dict":
         return self._find_node(name, Dict)
@@ -112,13 +1955,402 @@ class Code:
     def find_set(self, name: str) -> "Set":
         return self._find_node(name, Set)
 
-    def __str__(self) -> str:
-        return astor.to_source(self.tree)
+    def _find_qualified(
+        self, name: str, node_cls: Type[Union["Dict", "List", "Set"]]
+    ) -> Union["Dict", "List", "Set", None]:
+        """
+        Like ``_find_node``, but also finds qualified names such as ``Class.attr`` and
+        targets of tuple unpacking.
+        """
+        container = self._find_node(name, node_cls)
+        if container is None:
+            found = self.find_all(re.compile(re.escape(name)), kinds=[node_cls])
+            container = found.get(name)
+        return container
+
+    def at(self, name: str, *keys: Any) -> Union["Dict", "List", "Set"]:
+        """
+        Return the dict, list or set nested in the container assigned to ``name``.
+
+        For example, ``code.at("CONFIG", "services", 0)`` wraps the first element of
+        ``CONFIG["services"]``. Keys index into dicts (literals or ``dict()`` calls)
+        and lists, and may be negative for lists. Resolved paths are cached until the
+        container holding them is modified, so repeated edits deep inside a large
+        value don't search it again. Modifications are logged under names such as
+        ``CONFIG['services'][0]``, which :meth:`replay` understands.
+
+        Raises
+        ------
+        KeyError
+            If ``name`` or one of the keys isn't found.
+        TypeError
+            If the path leads through or to a value that isn't a dict, list or set.
+        """
+        entry = self._paths.get(name)
+        if entry is None:
+            with self._phase("lookup"):
+                wrapper = self._find_qualified(name, _Container)
+            if wrapper is None:
+                raise KeyError(f"{name} not found")
+            entry = self._paths[name] = [wrapper, {}]
+        for i, key in enumerate(keys):
+            wrapper, children = entry
+            entry = children.get(key)
+            if entry is not None:
+                continue
+            with self._phase("lookup"):
+                node = wrapper._child(key)
+            path = _path_name(name, keys[: i + 1])
+            if node is None:
+                raise KeyError(f"{path} not found")
+            child = self._wrap(node, wrapper.stmt, path)
+            if child is None:
+                raise TypeError(f"{path} is not a dict, list or set")
+            entry = children[key] = [child, {}]
+        return entry[0]
+
+    def _forget_paths(self, name: str) -> None:
+        """Drop the cached paths inside the container ``name``, after it changed."""
+        path = _split_path(name) if "[" in name else (name,)
+        entry = self._paths.get(path[0])
+        for key in path[1:]:
+            if entry is None:
+                return
+            entry = entry[1].get(key)
+        if entry is not None:
+            entry[1].clear()
 
+    def replay(self, operations: Iterable[Operation], strict: bool = True) -> int:
+        """
+        Apply operations recorded in the log of another Code.
+
+        Parameters
+        ----------
+        operations: iterable of Operation
+            The operations, e.g. ``other.log`` or the result of :func:`deserialize_log`
+            or :func:`compact_log`.
+        strict: bool, default=True
+            Whether to raise a KeyError when a container isn't found. Otherwise its
+            operations are skipped.
+
+        Returns
+        -------
+        int
+            The number of operations applied.
+
+        Raises
+        ------
+        ValueError
+            If an operation calls a method that doesn't modify the container.
+        """
+        classes = {"dict": Dict, "list": List, "set": Set}
+        containers = {}
+        applied = 0
+        for operation in operations:
+            node_cls = classes[operation.kind]
+            target = operation.kind, operation.name
+            if "[" in operation.name:
+                # Nested containers are looked up every time, since the containers
+                # holding them may have been changed since
+                try:
+                    container = self.at(*_split_path(operation.name))
+                except (KeyError, TypeError):
+                    container = None
+                if not isinstance(container, node_cls):
+                    container = None
+            elif target in containers:
+                container = containers[target]
+            else:
+                container = self._find_qualified(operation.name, node_cls)
+                containers[target] = container
+            if container is None:
+                if strict:
+                    raise KeyError(f"{operation.kind} {operation.name} not found")
+                continue
+            method = getattr(type(container), operation.method, None)
+            if not getattr(method, "_mutator", False):
+                raise ValueError(
+                    f"{operation.method!r} isn't a method that modifies a "
+                    f"{operation.kind}"
+                )
+            method(container, *operation.args, **operation.kwargs)
+            applied += 1
+        return applied
+
+    def load(self, name: str) -> Any:
+        """
+        Return the value assigned to ``name`` as a Python object.
+
+        Raises
+        ------
+        KeyError
+            If there is no assignment to ``name``.
+        ValueError
+            If the assigned value is not a literal.
+        """
+        with self._phase("lookup"):
+            for node in self._assignments(name):
+                if _assigned_name(node) == name:
+                    return get_value_from_ast_node(node.value)
+        raise KeyError(f"{name} not found")
+
+    def _mark_modified(self, stmt: Optional[ast.stmt]) -> None:
+        """Record that ``stmt`` was modified. ``None`` means the change can't be localized."""
+        self._modified[id(stmt)] = stmt
+
+    def _offset(self, lineno: int, col_offset: int) -> int:
+        """Convert an AST position (1-based line, UTF-8 byte column) to an index into ``source``."""
+        if self._line_starts is None:
+            self._line_starts = [0]
+            if isinstance(self.source, str):
+                for line in self.source.splitlines(keepends=True):
+                    self._line_starts.append(self._line_starts[-1] + len(line))
+            else:
+                for match in re.finditer(rb"\r\n|\r|\n", self.source):
+                    self._line_starts.append(match.end())
+                self._line_starts.append(len(self.source))
+        start = self._line_starts[lineno - 1]
+        if not isinstance(self.source, str):
+            return start + col_offset
+        line = self.source[start : self._line_starts[lineno]]
+        if line.isascii():
+            return start + col_offset
+        return start + len(line.encode("utf-8")[:col_offset].decode("utf-8"))
+
+    def _splice_chunks(self, formatter: Optional[Callable[..., str]]) -> Optional[list]:
+        """
+        Plan a splice as a list of ``(start, end)`` ranges of the original source and
+        rendered replacement text, in output order. None if it isn't possible.
+        """
+        spans = []
+        for stmt in self._modified.values():
+            if id(stmt) in self._spans:
+                start, end = self._spans[id(stmt)]
+            elif stmt is None or getattr(stmt, "end_lineno", None) is None:
+                return None
+            else:
+                start = self._offset(stmt.lineno, stmt.col_offset)
+                end = self._offset(stmt.end_lineno, stmt.end_col_offset)
+            spans.append((start, end, stmt))
+        spans.sort(key=lambda span: span[0])
+
+        is_text = isinstance(self.source, str)
+        newline = "\n" if is_text else b"\n"
+        chunks = []
+        position = 0
+        for start, end, stmt in spans:
+            if start < position:
+                # Nested inside a statement that has already been re-rendered
+                continue
+            line_start = self.source.rfind(newline, 0, start) + 1
+            prefix = self.source[line_start:start]
+            indent = prefix[: len(prefix) - len(prefix.lstrip())]
+            if not is_text:
+                indent = indent.decode("utf-8")
+            with self._phase("render"):
+                text = _render(stmt)
+            if formatter is not None:
+                with self._phase("format"):
+                    text = formatter(text, line_length=88 - len(indent))
+            text = text.rstrip("\n").replace("\n", "\n" + indent)
+            chunks.append((position, start))
+            chunks.append(text if is_text else text.encode("utf-8"))
+            position = end
+        chunks.append((position, len(self.source)))
+        return chunks
+
+    def splice(
+        self, formatter: Optional[Callable[..., str]] = None
+    ) -> Union[str, bytes, None]:
+        """
+        Render the modified statements and splice them into the original source.
+
+        Parameters
+        ----------
+        formatter: callable, optional
+            Called on each rendered statement as ``formatter(text, line_length=...)``.
+
+        Returns
+        -------
+        str, bytes or None
+            The new source code (bytes if the source is a bytes-like buffer), or None
+            if the modifications can't be located in the original text (e.g. a change
+            that wasn't made through a wrapper).
+        """
+        chunks = self._splice_chunks(formatter)
+        if chunks is None:
+            return None
+        empty = "" if isinstance(self.source, str) else b""
+        return empty.join(
+            self.source[chunk[0] : chunk[1]] if isinstance(chunk, tuple) else chunk
+            for chunk in chunks
+        )
+
+    def splice_to(
+        self,
+        file,
+        formatter: Optional[Callable[..., str]] = None,
+        block_size: int = 1 << 20,
+    ) -> bool:
+        """
+        Like :meth:`splice`, but write the result to ``file`` as it is produced.
 
-class Dict(abc.ABC):
-    def __init__(self, node: ast.AST):
+        Unmodified parts of the source are copied ``block_size`` characters (or bytes)
+        at a time, so the new source is never held in memory as a whole. ``file`` must
+        be opened in text mode for str sources and binary mode otherwise.
+
+        Returns
+        -------
+        bool
+            False if the modifications can't be located in the original text, in
+            which case nothing is written.
+        """
+        chunks = self._splice_chunks(formatter)
+        if chunks is None:
+            return False
+        for chunk in chunks:
+            if not isinstance(chunk, tuple):
+                file.write(chunk)
+                continue
+            for position in range(chunk[0], chunk[1], block_size):
+                file.write(self.source[position : min(position + block_size, chunk[1])])
+        return True
+
+    def __str__(self) -> str:
+        if self.engine == "tokens":
+            source_code = self.splice()
+            if isinstance(source_code, str):
+                return source_code
+            if source_code is not None:
+                return bytes(source_code).decode()
+            # The changes can't be located in the source, so render the whole tree
+        with self._phase("render"):
+            return _render(self.tree)
+
+
+class _Container(abc.ABC):
+    _kind = None
+    _mutating = False
+    _changed = True
+
+    def __init__(
+        self,
+        node: ast.AST,
+        code: Optional[Code] = None,
+        stmt: Optional[ast.stmt] = None,
+        name: Optional[str] = None,
+    ):
+        """
+        Parameters
+        ----------
+        node: ast.AST
+            The node holding the container. Literal containers may also be given the
+            assignment statement whose value they are.
+        code: Code, optional
+            The document the node belongs to. Modifications are reported to it.
+        stmt: ast.stmt, optional
+            The statement that contains ``node``, re-rendered when writing in splice mode.
+        name: str, optional
+            The (qualified) name the container was found under. Modifications are
+            recorded in the operation log of ``code`` under this name.
+        """
         self.node = node
+        self.code = code
+        self.stmt = stmt
+        self.name = name
+
+    @property
+    def _value(self) -> ast.AST:
+        """The container expression: the value of ``node`` if it is an assignment."""
+        if isinstance(self.node, (ast.Assign, ast.AnnAssign)):
+            return self.node.value
+        return self.node
+
+    @abc.abstractmethod
+    def to_python(self) -> Any:
+        """Convert the container to the equivalent Python object."""
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def _child(self, key: Any) -> Optional[ast.AST]:
+        """The node holding the element at ``key``, or None if there is none."""
+        raise TypeError(f"Elements of a {self._kind} can't be looked up by key")
+
+
+_NO_KEY = object()
+
+
+class _KeyIndex(abc.ABC):
+    """
+    Mixin that keeps a lazily built index from constant keys to their positions.
+
+    Used by the dict and set wrappers so that lookups don't scan every node. The
+    index is rebuilt if the number of keys changes without going through the wrapper.
+    """
+
+    _index = None
+    _index_size = 0
+
+    @abc.abstractmethod
+    def _keys(self) -> list:
+        """The list of nodes holding the keys, in order."""
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    @staticmethod
+    @abc.abstractmethod
+    def _key_value(key_node: ast.AST) -> Any:
+        """The key held by ``key_node``, or ``_NO_KEY`` if it is not a constant."""
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def _key_index(self) -> dict:
+        """Map each constant key to the position of its first occurrence."""
+        keys = self._keys()
+        if self._index is None or self._index_size != len(keys):
+            index = {}
+            for i, key_node in enumerate(keys):
+                key = self._key_value(key_node)
+                if key is not _NO_KEY:
+                    index.setdefault(key, i)
+            self._index = index
+            self._index_size = len(keys)
+        return self._index
+
+    def _position(self, key: Any) -> Optional[int]:
+        """Return the position of ``key``, or None if it is not present."""
+        try:
+            i = self._key_index().get(key)
+        except TypeError:
+            # Unhashable keys can't match a constant key
+            return None
+        if i is not None and self._key_value(self._keys()[i]) != key:
+            # The keys were changed without going through this wrapper
+            self._index = None
+            i = self._key_index().get(key)
+        return i
+
+    def _added(self, key_node: ast.AST) -> None:
+        """Record a key node appended to the end of the keys."""
+        key = self._key_value(key_node)
+        if key is not _NO_KEY:
+            self._index.setdefault(key, self._index_size)
+        self._index_size += 1
+
+    def _removed(self, key: Any, i: int) -> None:
+        """Shift the positions after ``i`` down after the key at ``i`` was deleted."""
+        index = self._index
+        del index[key]
+        keys = self._keys()
+        for j in range(i, len(keys)):
+            key_j = self._key_value(keys[j])
+            if key_j is _NO_KEY:
+                continue
+            position = index.get(key_j)
+            if position is None or position == j + 1:
+                index[key_j] = j
+        self._index_size = len(keys)
+
+
+class Dict(_KeyIndex, _Container):
+    _kind = "dict"
 
     @abc.abstractmethod
     def pop(self, key: Any) -> Optional[Any]:
@@ -136,84 +2368,168 @@ class Dict(abc.ABC):
     def clear(self) -> None:
         raise NotImplementedError("Subclasses should implement this method.")
 
+    @abc.abstractmethod
+    def _items(self) -> Iterator[Tuple[ast.AST, ast.AST]]:
+        """Iterate over the key and value nodes."""
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def _python_key(self, key_node: ast.AST) -> Any:
+        key = self._key_value(key_node)
+        return get_value_from_ast_node(key_node) if key is _NO_KEY else key
+
+    def items(self) -> Iterator[Tuple[Any, Any]]:
+        """Iterate over the keys and values, converting them as they are reached."""
+        for key_node, value_node in self._items():
+            yield self._python_key(key_node), get_value_from_ast_node(value_node)
+
+    def keys(self) -> Iterator[Any]:
+        return (self._python_key(key_node) for key_node, _ in self._items())
+
+    def values(self) -> Iterator[Any]:
+        return (get_value_from_ast_node(value_node) for _, value_node in self._items())
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.keys()
+
+    def __len__(self) -> int:
+        return len(self._keys())
+
+    def to_python(self) -> dict:
+        return dict(self.items())
+
 
 class LiteralDict(Dict):
-    def pop(self, key: str) -> None:
-        key_nodes = self.node.value.keys
-        value_nodes = self.node.value.values
-        for i, key_node in enumerate(key_nodes):
-            if isinstance(key_node, ast.Constant) and key_node.value == key:
-                value = value_nodes[i]
-                del key_nodes[i]
-                del value_nodes[i]
-                return value
+    def _keys(self) -> list:
+        return self._value.keys
 
+    @staticmethod
+    def _key_value(key_node: ast.AST) -> Any:
+        return key_node.value if isinstance(key_node, ast.Constant) else _NO_KEY
+
+    def _items(self) -> Iterator[Tuple[ast.AST, ast.AST]]:
+        for key_node, value_node in zip(self._value.keys, self._value.values):
+            if key_node is None:
+                raise ValueError("Can't convert a dict containing ** unpacking")
+            yield key_node, value_node
+
+    @_mutator
+    def pop(self, key: str) -> None:
+        i = self._position(key)
+        if i is not None:
+            value = self._value.values[i]
+            del self._value.keys[i]
+            del self._value.values[i]
+            self._removed(key, i)
+            return value
+        self._changed = False
+
+    @_mutator
     def update(self, dict_: dict = None, **kwargs) -> None:
+        changed = False
         if dict_ is not None:
             for key, value in dict_.items():
-                self._update(key, value)
+                changed = self._update(key, value) or changed
         for key, value in kwargs.items():
-            self._update(key, value)
+            changed = self._update(key, value) or changed
+        self._changed = changed
 
-    def _update(self, key: str, value: Any) -> None:
+    def _update(self, key: str, value: Any) -> bool:
         value_node = get_ast_node_from_value(value)
-        for i, key_node in enumerate(self.node.value.keys):
-            if isinstance(key_node, ast.Constant) and key_node.value == key:
-                self.node.value.values[i] = value_node
-                return
-        self.node.value.keys.append(ast.Constant(value=key))
-        self.node.value.values.append(value_node)
+        i = self._position(key)
+        if i is not None:
+            if _same_constant(self._value.values[i], value_node):
+                return False
+            self._value.values[i] = value_node
+            return True
+        self._value.keys.append(ast.Constant(value=key))
+        self._value.values.append(value_node)
+        self._added(self._value.keys[-1])
+        return True
 
     def get(self, key: str, default: Any = None) -> Any:
-        for key_node, value_node in zip(self.node.value.keys, self.node.value.values):
-            if (
-                isinstance(key_node, (ast.Constant, ast.Str, ast.Num))
-                and key_node.value == key
-            ):
-                return value_node.value
+        i = self._position(key)
+        if i is not None:
+            return get_value_from_ast_node(self._value.values[i])
         return default
 
+    def _child(self, key: Any) -> Optional[ast.AST]:
+        i = self._position(key)
+        return None if i is None else self._value.values[i]
+
+    @_mutator
     def clear(self) -> None:
-        self.node.value.keys.clear()
-        self.node.value.values.clear()
+        self._changed = bool(self._value.keys)
+        self._value.keys.clear()
+        self._value.values.clear()
+        self._index = None
 
 
 class FunctionCallDict(Dict):
+    def _keys(self) -> list:
+        return self.node.keywords
+
+    @staticmethod
+    def _key_value(key_node: ast.AST) -> Any:
+        # ``**kwargs`` entries have no name
+        return _NO_KEY if key_node.arg is None else key_node.arg
+
+    def _items(self) -> Iterator[Tuple[ast.AST, ast.AST]]:
+        for kw in self.node.keywords:
+            if kw.arg is None:
+                raise ValueError("Can't convert a call with ** unpacking")
+            yield kw, kw.value
+
+    @_mutator
     def update(self, dict_: dict = None, **kwargs) -> None:
+        changed = False
         if dict_ is not None:
             for key, value in dict_.items():
-                self._update(key, value)
+                changed = self._update(key, value) or changed
         for key, value in kwargs.items():
-            self._update(key, value)
+            changed = self._update(key, value) or changed
+        self._changed = changed
 
-    def _update(self, key: str, value: Any) -> None:
+    def _update(self, key: str, value: Any) -> bool:
         value_node = get_ast_node_from_value(value)
-        for i, kw in enumerate(self.node.keywords):
-            if kw.arg == key:
-                kw.value = value_node
-                return
+        i = self._position(key)
+        if i is not None:
+            if _same_constant(self.node.keywords[i].value, value_node):
+                return False
+            self.node.keywords[i].value = value_node
+            return True
         self.node.keywords.append(ast.keyword(arg=key, value=value_node))
+        self._added(self.node.keywords[-1])
+        return True
 
     def get(self, key: Any, default: Any = None) -> Any:
-        for kw in self.node.keywords:
-            if kw.arg == key:
-                return kw.value.value
+        i = self._position(key)
+        if i is not None:
+            return get_value_from_ast_node(self.node.keywords[i].value)
         return default
 
+    def _child(self, key: Any) -> Optional[ast.AST]:
+        i = self._position(key)
+        return None if i is None else self.node.keywords[i].value
+
+    @_mutator
     def clear(self) -> None:
+        self._changed = bool(self.node.keywords)
         self.node.keywords.clear()
+        self._index = None
 
+    @_mutator
     def pop(self, key: str) -> Optional[Any]:
-        for i, kw in enumerate(self.node.keywords):
-            if kw.arg == key:
-                value = kw.value
-                del self.node.keywords[i]
-                return value
+        i = self._position(key)
+        if i is not None:
+            value = self.node.keywords[i].value
+            del self.node.keywords[i]
+            self._removed(key, i)
+            return value
+        self._changed = False
 
 
-class List(abc.ABC):
-    def __init__(self, node: ast.AST):
-        self.node = node
+class List(_Container):
+    _kind = "list"
 
     @abc.abstractmethod
     def pop(self, index: int) -> None:
@@ -231,49 +2547,149 @@ class List(abc.ABC):
     def remove(self, value: Any) -> None:
         raise NotImplementedError("Subclasses should implement this method.")
 
+    @abc.abstractmethod
+    def _elts(self) -> list:
+        """The list of element nodes."""
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def __len__(self) -> int:
+        return len(self._elts())
+
+    def __iter__(self) -> Iterator[Any]:
+        return (get_value_from_ast_node(elt) for elt in self._elts())
+
+    def _child(self, index: Any) -> Optional[ast.AST]:
+        if not isinstance(index, int) or isinstance(index, bool):
+            raise TypeError(
+                f"List indices must be integers, not {type(index).__name__}"
+            )
+        elts = self._elts()
+        return elts[index] if -len(elts) <= index < len(elts) else None
+
+    def to_python(self) -> list:
+        return list(self)
+
+    @_mutator
+    def __setitem__(self, index: Union[int, slice], value: Any) -> None:
+        if isinstance(index, slice):
+            self._elts()[index] = [get_ast_node_from_value(v) for v in value]
+        else:
+            self._elts()[index] = get_ast_node_from_value(value)
+
+    @_mutator
     def extend(self, values: list) -> None:
-        for value in values:
-            self.append(value)
+        elts = self._elts()
+        nodes = _element_nodes(values)
+        self._changed = bool(nodes)
+        elts[len(elts) :] = nodes
+
+    @_mutator
+    def remove_all(self, values: list) -> None:
+        """Remove every occurrence of each of ``values``, in a single pass."""
+        try:
+            values = set(values)
+        except TypeError:
+            values = list(values)
+        elts = self._elts()
+        size = len(elts)
+        elts[:] = [
+            elt
+            for elt in elts
+            if not (isinstance(elt, ast.Constant) and elt.value in values)
+        ]
+        self._changed = len(elts) != size
+
+    @_mutator
+    def filter(self, predicate: Callable[[Any], bool]) -> None:
+        """
+        Keep only the elements for which ``predicate`` returns True.
+
+        ``predicate`` is called with the value of each element, or with the node itself
+        for elements that are not literals.
+        """
+
+        def value(elt):
+            try:
+                return get_value_from_ast_node(elt)
+            except ValueError:
+                return elt
+
+        elts = self._elts()
+        size = len(elts)
+        elts[:] = [elt for elt in elts if predicate(value(elt))]
+        self._changed = len(elts) != size
+
+    @_mutator
+    def sort(
+        self, key: Optional[Callable[[Any], Any]] = None, reverse: bool = False
+    ) -> None:
+        """Sort the elements in place. All elements must be constants."""
+        elts = self._elts()
+        if not all(isinstance(elt, ast.Constant) for elt in elts):
+            raise TypeError("Only lists of constants can be sorted")
+        before = list(elts)
+        if key is None:
+            elts.sort(key=lambda elt: elt.value, reverse=reverse)
+        else:
+            elts.sort(key=lambda elt: key(elt.value), reverse=reverse)
+        self._changed = any(old is not new for old, new in zip(before, elts))
 
 
 class LiteralList(List):
+    def _elts(self) -> list:
+        return self._value.elts
+
+    @_mutator
     def pop(self, index: int) -> None:
-        value = self.node.value.elts[index]
-        del self.node.value.elts[index]
+        value = self._value.elts[index]
+        del self._value.elts[index]
         return value
 
+    @_mutator
     def append(self, value: Any) -> None:
-        self.node.value.elts.append(get_ast_node_from_value(value))
+        self._value.elts.append(get_ast_node_from_value(value))
 
+    @_mutator
     def insert(self, index: int, value: Any) -> None:
-        self.node.value.elts.insert(index, get_ast_node_from_value(value))
+        self._value.elts.insert(index, get_ast_node_from_value(value))
 
+    @_mutator
     def remove(self, value: Any) -> None:
-        for i, elt in enumerate(self.node.value.elts):
+        for i, elt in enumerate(self._value.elts):
             if isinstance(elt, (ast.Constant, ast.Str, ast.Num)) and elt.value == value:
-                del self.node.value.elts[i]
+                del self._value.elts[i]
                 return
         raise ValueError(f"{value} not found in list")
 
+    @_mutator
     def clear(self) -> None:
-        self.node.value.elts = []
+        self._changed = bool(self._value.elts)
+        self._value.elts = []
 
+    @_mutator
     def reverse(self) -> None:
-        self.node.value.elts.reverse()
+        self._value.elts.reverse()
 
 
 class FunctionCallList(List):
+    def _elts(self) -> list:
+        return self.node.args
+
+    @_mutator
     def pop(self, index: int) -> None:
         value = self.node.args[index]
         del self.node.args[index]
         return value
 
+    @_mutator
     def append(self, value: Any) -> None:
         self.node.args.append(get_ast_node_from_value(value))
 
+    @_mutator
     def insert(self, index: int, value: Any) -> None:
         self.node.args.insert(index, get_ast_node_from_value(value))
 
+    @_mutator
     def remove(self, value: Any) -> None:
         for i, elt in enumerate(self.node.args):
             if isinstance(elt, (ast.Constant, ast.Str, ast.Num)) and elt.value == value:
@@ -281,17 +2697,18 @@ class FunctionCallList(List):
                 return
         raise ValueError(f"{value} not found in list")
 
+    @_mutator
     def clear(self) -> None:
-        for i in range(len(self.node.args)):
-            self.pop(0)
+        self._changed = bool(self.node.args)
+        self.node.args.clear()
 
+    @_mutator
     def reverse(self) -> None:
         self.node.args.reverse()
 
 
-class Set(abc.ABC):
-    def __init__(self, node: ast.AST):
-        self.node = node
+class Set(_KeyIndex, _Container):
+    _kind = "set"
 
     @abc.abstractmethod
     def add(self, value: Any) -> None:
@@ -305,48 +2722,573 @@ class Set(abc.ABC):
     def discard(self, value: Any) -> None:
         raise NotImplementedError("Subclasses should implement this method.")
 
+    @staticmethod
+    def _key_value(key_node: ast.AST) -> Any:
+        return key_node.value if isinstance(key_node, ast.Constant) else _NO_KEY
+
+    def __contains__(self, value: Any) -> bool:
+        return self._position(value) is not None
+
+    def __len__(self) -> int:
+        return len(self._keys())
+
+    def __iter__(self) -> Iterator[Any]:
+        return (get_value_from_ast_node(elt) for elt in self._keys())
+
+    def to_python(self) -> set:
+        return set(self)
+
+    @_mutator
     def update(self, values: list) -> None:
+        index = self._key_index()
+        elts = self._keys()
+        new_elts = []
         for value in values:
-            self.add(value)
+            try:
+                if value in index:
+                    continue
+            except TypeError:
+                pass
+            node = get_ast_node_from_value(value)
+            if isinstance(node, ast.Constant):
+                index[value] = len(elts) + len(new_elts)
+            new_elts.append(node)
+        elts.extend(new_elts)
+        self._index_size = len(elts)
+        self._changed = bool(new_elts)
+
+    def _add(self, value: Any) -> bool:
+        """Add ``value`` and return whether it was missing."""
+        if self._position(value) is not None:
+            return False
+        self._keys().append(get_ast_node_from_value(value))
+        self._added(self._keys()[-1])
+        return True
+
+    def _discard(self, value: Any) -> bool:
+        """Remove ``value`` and return whether it was present."""
+        i = self._position(value)
+        if i is None:
+            return False
+        del self._keys()[i]
+        self._removed(value, i)
+        return True
 
 
 class LiteralSet(Set):
+    def _keys(self) -> list:
+        return self._value.elts
+
+    @_mutator
     def add(self, value: Any) -> None:
-        for elt in self.node.value.elts:
-            if isinstance(elt, (ast.Constant, ast.Str, ast.Num)) and elt.value == value:
-                return
-        self.node.value.elts.append(get_ast_node_from_value(value))
+        self._changed = self._add(value)
 
+    @_mutator
     def remove(self, value: Any) -> None:
-        for i, elt in enumerate(self.node.value.elts):
-            if isinstance(elt, (ast.Constant, ast.Str, ast.Num)) and elt.value == value:
-                del self.node.value.elts[i]
-                return
-        raise KeyError(f"{value} not found in set")
+        if not self._discard(value):
+            raise KeyError(f"{value} not found in set")
 
+    @_mutator
     def discard(self, value: Any) -> None:
-        try:
-            self.remove(value)
-        except KeyError:
-            pass
+        self._changed = self._discard(value)
 
 
 class FunctionCallSet(Set):
+    def _keys(self) -> list:
+        return self.node.args
+
+    @_mutator
     def add(self, value: Any) -> None:
-        for elt in self.node.args:
-            if isinstance(elt, (ast.Constant, ast.Str, ast.Num)) and elt.value == value:
-                return
-        self.node.args.append(get_ast_node_from_value(value))
+        self._changed = self._add(value)
 
+    @_mutator
     def remove(self, value: Any) -> None:
-        for i, elt in enumerate(self.node.args):
-            if isinstance(elt, (ast.Constant, ast.Str, ast.Num)) and elt.value == value:
-                del self.node.args[i]
-                return
-        raise KeyError(f"{value} not found in set")
+        if not self._discard(value):
+            raise KeyError(f"{value} not found in set")
 
+    @_mutator
     def discard(self, value: Any) -> None:
-        for i, elt in enumerate(self.node.args):
-            if isinstance(elt, (ast.Constant, ast.Str, ast.Num)) and elt.value == value:
-                del self.node.args[i]
-                return
+        self._changed = self._discard(value)
+
+
+def _error_from(type_name: str, message: str) -> Exception:
+    """Recreate an error reported by another process, as a built-in type if possible."""
+    import builtins
+
+    error_cls = getattr(builtins, type_name, None)
+    if not (isinstance(error_cls, type) and issubclass(error_cls, Exception)):
+        error_cls = RuntimeError
+    return error_cls(message)
+
+
+def default_socket_path() -> str:
+    """The socket :class:`Server` listens on by default: ``$CODE_CRAFTER_SOCKET``, or a
+    per-user socket in ``$XDG_RUNTIME_DIR`` or ``/tmp``."""
+    if os.environ.get("CODE_CRAFTER_SOCKET"):
+        return os.environ["CODE_CRAFTER_SOCKET"]
+    directory = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(directory, f"code-crafter-{os.getuid()}.sock")
+
+
+class Server:
+    """
+    Keeps recently edited files parsed in memory and edits them on request.
+
+    Clients connect to a Unix socket and send requests as lines of JSON, see
+    :class:`Client`. Edits to the same file that arrive within ``flush_delay`` of
+    each other are written in a single write. Files changed on disk are re-read, with
+    any edits that weren't written yet applied again on top.
+    """
+
+    def __init__(
+        self,
+        socket_path: Optional[str] = None,
+        max_files: int = 128,
+        flush_delay: float = 0.1,
+        send_timeout: float = 10.0,
+        **file_kwargs,
+    ):
+        """
+        Parameters
+        ----------
+        socket_path: str, optional
+            Where to listen. Defaults to :func:`default_socket_path`.
+        max_files: int, default=128
+            Maximum number of files kept in memory. Pending edits to evicted files are
+            written first.
+        flush_delay: float, default=0.1
+            Seconds to wait after the first edit to a file before writing it, to
+            collect the edits that follow it.
+        send_timeout: float, default=10.0
+            Seconds to wait for a client to accept a response before dropping its
+            connection.
+        **file_kwargs
+            Passed on to :class:`File`, e.g. ``formatter`` or ``write_mode``.
+        """
+        self.socket_path = socket_path or default_socket_path()
+        self.max_files = max_files
+        self.flush_delay = flush_delay
+        self.send_timeout = send_timeout
+        self.file_kwargs = file_kwargs
+        self.hits = 0
+        self.misses = 0
+        self.edits = 0
+        self.writes = 0
+        self._files = collections.OrderedDict()
+        self._stamps = {}
+        # Path -> time at which its pending edits are written
+        self._due = {}
+        self._stopping = False
+
+    def serve_forever(self) -> None:
+        """
+        Accept requests until a client sends "shutdown", then write pending edits.
+
+        Connections are served together, one request at a time, so clients may keep
+        theirs open between requests.
+        """
+        import selectors
+        import socket
+
+        self._remove_stale_socket()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        selector = selectors.DefaultSelector()
+        try:
+            listener.bind(self.socket_path)
+            # Requests can edit any file the server's user can write
+            os.chmod(self.socket_path, 0o600)
+            listener.listen()
+            selector.register(listener, selectors.EVENT_READ)
+            self._stopping = False
+            while not self._stopping:
+                timeout = None
+                if self._due:
+                    timeout = max(0.0, min(self._due.values()) - time.monotonic())
+                for key, _ in selector.select(timeout):
+                    if key.fileobj is listener:
+                        connection, _ = listener.accept()
+                        # Only read when ready, but don't wait forever on a client
+                        # that doesn't read its responses
+                        connection.settimeout(self.send_timeout)
+                        selector.register(connection, selectors.EVENT_READ, bytearray())
+                    elif not self._serve_ready(key.fileobj, key.data):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    if self._stopping:
+                        break
+                self._flush_due()
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+            for path in list(self._due):
+                self._flush_logged(path)
+
+    def _remove_stale_socket(self) -> None:
+        import socket
+
+        if not os.path.exists(self.socket_path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError(
+                    f"A server is already listening on {self.socket_path}"
+                )
+
+    def _serve_ready(self, connection, buffer: bytearray) -> bool:
+        """
+        Answer the complete requests received on ``connection``.
+
+        Returns whether to keep the connection open.
+        """
+        import json
+
+        try:
+            data = connection.recv(1 << 16)
+        except OSError:
+            return False
+        if not data:
+            return False
+        buffer += data
+        *lines, rest = buffer.split(b"\n")
+        buffer[:] = rest
+        for line in lines:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"error": f"Invalid request: {e}", "type": "ValueError"}
+            else:
+                response = self.handle(request)
+            try:
+                connection.sendall(json.dumps(response).encode("utf-8") + b"\n")
+            except OSError:
+                # The client went away or stopped reading
+                return False
+            if self._stopping:
+                return False
+        return True
+
+    def handle(self, request: dict) -> dict:
+        """
+        Handle one request, returning the response.
+
+        Requests have an "op" and its fields:
+
+        - "find": "path", "name" and optionally "kind" ("dict", "list" or "set").
+          Responds with the "kind" and "source" of the container.
+        - "load": "path" and "name". Responds with the "value" as a Python literal.
+        - "edit": "path", "operations" written by :func:`serialize_log` and optionally
+          "flush" to write the file before responding. Responds with the number of
+          operations "applied". Either all operations are applied or none are.
+        - "flush": optionally "path". Writes pending edits, responding with the paths
+          "written".
+        - "stats": responds with cache and write counts.
+        - "shutdown": stops the server once pending edits are written.
+
+        Failed requests respond with the "error" and its "type".
+        """
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("Requests must be JSON objects")
+            op = request["op"]
+            if op == "find":
+                return self._find(request["path"], request["name"], request.get("kind"))
+            if op == "load":
+                value = self._open(request["path"]).load(request["name"])
+                return {"value": _render(get_ast_node_from_value(value)).strip()}
+            if op == "edit":
+                operations = deserialize_log(request["operations"])
+                applied = self._edit(request["path"], operations)
+                if request.get("flush"):
+                    self._flush(os.path.abspath(request["path"]))
+                return {"applied": applied}
+            if op == "flush":
+                paths = list(self._due)
+                if request.get("path") is not None:
+                    path = os.path.abspath(request["path"])
+                    paths = [path] if path in self._due else []
+                for path in paths:
+                    self._flush(path)
+                return {"written": paths}
+            if op == "stats":
+                return {
+                    "files": len(self._files),
+                    "pending": len(self._due),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "edits": self.edits,
+                    "writes": self.writes,
+                }
+            if op == "shutdown":
+                self._stopping = True
+                return {}
+            raise ValueError(f"Unknown op: {op!r}")
+        except Exception as e:
+            return {"error": str(e), "type": type(e).__name__}
+
+    def _open(self, path: str, pending: Iterable[Operation] = ()) -> File:
+        """Return the open File for ``path``, re-reading it if it changed on disk."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        file = self._files.get(path)
+        if file is not None and self._stamps[path] == stamp and not pending:
+            self._files.move_to_end(path)
+            self.hits += 1
+            return file
+        if file is not None and not pending:
+            # Changed on disk: keep the edits that weren't written yet
+            pending = list(file.code.log)
+        self.misses += 1
+        file = File(path, **self.file_kwargs).__enter__()
+        file.replay(pending)
+        self._files[path] = file
+        self._files.move_to_end(path)
+        self._stamps[path] = stamp
+        while len(self._files) > self.max_files:
+            evicted = next(iter(self._files))
+            if evicted in self._due:
+                self._flush_logged(evicted)
+            self._files.pop(evicted, None)
+            self._stamps.pop(evicted, None)
+        return file
+
+    def _find(self, path: str, name: str, kind: Optional[str]) -> dict:
+        node_cls = {"dict": Dict, "list": List, "set": Set, None: _Container}[kind]
+        container = self._open(path).code._find_node(name, node_cls)
+        if container is None:
+            raise KeyError(f"{kind or 'container'} {name} not found")
+        return {"kind": container._kind, "source": _render(container._value).strip()}
+
+    def _edit(self, path: str, operations: list) -> int:
+        file = self._open(path)
+        path = file.filename
+        pending = list(file.code.log)
+        try:
+            applied = file.replay(operations)
+        except Exception:
+            if file.code.modified:
+                # Roll back to the edits made before this request
+                if pending:
+                    self._open(path, pending)
+                else:
+                    self._drop(path)
+            raise
+        self.edits += applied
+        if file.code.modified:
+            self._due.setdefault(path, time.monotonic() + self.flush_delay)
+        return applied
+
+    def _drop(self, path: str) -> None:
+        self._files.pop(path, None)
+        self._stamps.pop(path, None)
+        self._due.pop(path, None)
+
+    def _flush(self, path: str) -> None:
+        """Write the pending edits to ``path``."""
+        self._due.pop(path, None)
+        file = self._files[path]
+        try:
+            file.__exit__(None, None, None)
+        except BaseException:
+            self._drop(path)
+            raise
+        self.writes += 1
+        if file.write_mode != "full" or file.read_mode != "full":
+            # The positions of the statements in the file changed, so re-read it
+            self._drop(path)
+            return
+        # The tree matches what was written, so it can be edited further
+        file.code._modified.clear()
+        file.code.log.clear()
+        stat = os.stat(path)
+        self._stamps[path] = (stat.st_mtime_ns, stat.st_size)
+
+    def _flush_due(self) -> None:
+        now = time.monotonic()
+        for path, due in list(self._due.items()):
+            if due <= now:
+                self._flush_logged(path)
+
+    def _flush_logged(self, path: str) -> None:
+        """Flush ``path``, reporting errors rather than raising them, as no client waits."""
+        try:
+            self._flush(path)
+        except Exception:
+            print(f"Failed to write {path}:", file=sys.stderr)
+            traceback.print_exc()
+
+
+class Client:
+    """
+    A connection to a :class:`Server`.
+
+    Errors raised by the server are raised again by the client, as built-in exception
+    types where possible and as RuntimeError otherwise.
+    """
+
+    def __init__(self, socket_path: Optional[str] = None):
+        import socket
+
+        self.socket_path = socket_path or default_socket_path()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(self.socket_path)
+        except BaseException:
+            self._socket.close()
+            raise
+        self._stream = self._socket.makefile("rwb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._stream.close()
+        self._socket.close()
+
+    def request(self, op: str, **fields) -> dict:
+        """Send a request (see :meth:`Server.handle`) and return the response."""
+        import json
+
+        self._stream.write(json.dumps(dict(fields, op=op)).encode("utf-8") + b"\n")
+        self._stream.flush()
+        line = self._stream.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise _error_from(response["type"], response["error"])
+        return response
+
+    def find(self, path: str, name: str, kind: Optional[str] = None) -> Tuple[str, str]:
+        """Return the kind and source of the container assigned to ``name``."""
+        response = self.request(
+            "find", path=os.path.abspath(path), name=name, kind=kind
+        )
+        return response["kind"], response["source"]
+
+    def load(self, path: str, name: str) -> Any:
+        response = self.request("load", path=os.path.abspath(path), name=name)
+        return get_value_from_ast_node(ast.parse(response["value"], mode="eval").body)
+
+    def edit(
+        self, path: str, operations: Iterable[Operation], flush: bool = False
+    ) -> int:
+        """
+        Apply operations to the file at ``path``.
+
+        The file is written after the server's ``flush_delay``, or before returning
+        with ``flush=True``.
+        """
+        response = self.request(
+            "edit",
+            path=os.path.abspath(path),
+            operations=serialize_log(operations),
+            flush=flush,
+        )
+        return response["applied"]
+
+    def flush(self, path: Optional[str] = None) -> "list[str]":
+        """Write pending edits, to ``path`` or to all files, returning the paths written."""
+        if path is not None:
+            path = os.path.abspath(path)
+        return self.request("flush", path=path)["written"]
+
+    def stats(self) -> dict:
+        return self.request("stats")
+
+    def shutdown(self) -> None:
+        self.request("shutdown")
+
+
+def main(argv: Optional["list[str]"] = None) -> int:
+    """Command line interface: run a :class:`Server`, or send it a request."""
+    import argparse
+
+    def literal(text):
+        try:
+            return get_value_from_ast_node(ast.parse(text, mode="eval").body)
+        except (SyntaxError, ValueError):
+            raise argparse.ArgumentTypeError(f"not a Python literal: {text}") from None
+
+    parser = argparse.ArgumentParser(
+        prog="code-crafter",
+        description="Edit Python files through a code-crafter server.",
+    )
+    parser.add_argument("--socket", help="socket of the server")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run a server")
+    serve.add_argument("--max-files", type=int, default=128)
+    serve.add_argument("--flush-delay", type=float, default=0.1)
+    serve.add_argument("--formatter", choices=sorted(_FORMATTERS), default="black")
+    serve.add_argument("--write-mode", choices=["full", "splice", "patch"])
+    find = commands.add_parser("find", help="print the source of a dict, list or set")
+    find.add_argument("path")
+    find.add_argument("name")
+    find.add_argument("--kind", choices=["dict", "list", "set"])
+    load = commands.add_parser("load", help="print the value assigned to a name")
+    load.add_argument("path")
+    load.add_argument("name")
+    edit = commands.add_parser(
+        "edit",
+        help="call a method of a dict, list or set",
+        description="Arguments are Python literals, e.g. \"'numpy'\" or \"{'a': 1}\".",
+    )
+    edit.add_argument("path")
+    edit.add_argument("kind", choices=["dict", "list", "set"])
+    edit.add_argument("name")
+    edit.add_argument("method")
+    edit.add_argument("args", nargs="*", type=literal)
+    edit.add_argument("--flush", action="store_true", help="write before returning")
+    flush = commands.add_parser("flush", help="write pending edits")
+    flush.add_argument("path", nargs="?")
+    commands.add_parser("stats", help="print the server's counters as JSON")
+    commands.add_parser("stop", help="stop the server")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        Server(
+            args.socket,
+            max_files=args.max_files,
+            flush_delay=args.flush_delay,
+            formatter=args.formatter,
+            write_mode=args.write_mode,
+        ).serve_forever()
+        return 0
+    try:
+        with Client(args.socket) as client:
+            if args.command == "find":
+                print(client.find(args.path, args.name, args.kind)[1])
+            elif args.command == "load":
+                print(repr(client.load(args.path, args.name)))
+            elif args.command == "edit":
+                operation = Operation(
+                    args.kind, args.name, args.method, tuple(args.args)
+                )
+                client.edit(args.path, [operation], flush=args.flush)
+            elif args.command == "flush":
+                for path in client.flush(args.path):
+                    print(path)
+            elif args.command == "stats":
+                import json
+
+                print(json.dumps(client.stats()))
+            elif args.command == "stop":
+                client.shutdown()
+    except Exception as e:
+        print(f"code-crafter: {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,27 @@
+import array
+import ast
+import dataclasses
+import enum
+import sys
+from typing import Any
+
+import astor
 import pytest
-from code_crafter import Code, File
+
+import code_crafter
+from code_crafter import (
+    AsyncFile,
+    Client,
+    Code,
+    File,
+    Operation,
+    ParseCache,
+    Server,
+    async_batch,
+    batch,
+    get_ast_node_from_value,
+    get_value_from_ast_node,
+)
 
 
 @pytest.fixture
@@ -263,3 +285,1061 @@ def test_file_context_manager_modifies_file(temp_python_file):
     assert 'my_dict = {"key": "value", "new_key": "new_value"}' in content
 
 
+
+
+def test_find_uses_index(sample_document, monkeypatch):
+    assert sample_document.find_list('my_list') is not None
+
+    def fail(*args, **kwargs):
+        raise AssertionError("lookup walked the tree again")
+
+    monkeypatch.setattr("code_crafter.ast.walk", fail)
+    assert sample_document.find_dict('my_dict') is not None
+    assert sample_document.find_set('my_set') is not None
+    assert sample_document.find_list('missing') is None
+
+
+def test_index_invalidation(sample_document):
+    assert sample_document.find_list('new_list') is None
+    sample_document.tree.body.append(ast.parse("new_list = [1]").body[0])
+    sample_document.invalidate_index()
+    assert sample_document.find_list('new_list') is not None
+
+    sample_document.tree = ast.parse("my_list = {}")
+    assert sample_document.find_list('my_list') is None
+    assert sample_document.find_dict('my_dict') is None
+
+
+def test_file_splice_preserves_untouched_source(tmp_path):
+    temp_file = tmp_path / "test_file.py"
+    temp_file.write_text("""# header comment
+my_list = [1, 2, 3]  # trailing comment
+my_dict = {'key': 'value'}
+
+
+class Config:
+    # nested comment
+    my_set = {1, 2}
+""")
+    with File(str(temp_file), write_mode="splice") as file:
+        file.find_list("my_list").append(4)
+
+    assert temp_file.read_text() == """# header comment
+my_list = [1, 2, 3, 4]  # trailing comment
+my_dict = {'key': 'value'}
+
+
+class Config:
+    # nested comment
+    my_set = {1, 2}
+"""
+
+    # Line endings are kept too
+    temp_file.write_bytes(b"x = [1]\r\ny = 2  # c\r\n")
+    with File(str(temp_file), write_mode="splice", formatter="none") as file:
+        file.find_list("x").append(2)
+    assert temp_file.read_bytes() == b"x = [1, 2]\r\ny = 2  # c\r\n"
+
+
+def test_code_splice_indented_and_multiline():
+    from code_crafter import _format_black
+
+    code = Code("def f():\n    x = 1; my_list = ['a']\n    return x\n")
+    code.find_list("my_list").extend(["b" * 40, "c" * 40])
+
+    assert code.splice(formatter=_format_black) == """def f():
+    x = 1; my_list = [
+        "a",
+        "bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb",
+        "cccccccccccccccccccccccccccccccccccccccc",
+    ]
+    return x
+"""
+
+
+def test_format_black_caches_only_statements():
+    from code_crafter import _format_black, _run_black_cached
+
+    _run_black_cached.cache_clear()
+    assert _format_black("x=[1]\n") == "x = [1]\n"
+    assert _format_black("x=[1]\n") == "x = [1]\n"
+    assert _run_black_cached.cache_info().hits == 1
+
+    whole_file = "x=[1]\n" * 1000
+    assert _format_black(whole_file) == "x = [1]\n" * 1000
+    assert _run_black_cached.cache_info().currsize == 1
+
+
+def test_tokens_engine_parses_only_what_it_edits(tmp_path):
+    temp_file = tmp_path / "test_file.py"
+    source = '''"""
+my_list = ['in a docstring']
+"""
+# header comment
+my_list = [
+    1,
+    2,
+]  # trailing comment
+my_dict = dict(key='value')
+if my_list == []:
+    my_set = {1}
+'''
+    temp_file.write_text(source)
+    with File(str(temp_file), engine="tokens") as file:
+        file.find_list("my_list").append(3)
+        file.find_dict("my_dict").update({"other": 1})
+        assert file.code._tree is None
+        # Not assigned at the top level, so the whole file is parsed
+        assert file.find_set("my_set").to_python() == {1}
+        # Names located before that still resolve to the statements edited so far
+        file.find_list("my_list").append(4)
+        assert file.load("my_list") == [1, 2, 3, 4]
+        # find_all too
+        file.code.find_all("my_list")["my_list"].append(5)
+
+    assert temp_file.read_text() == source.replace(
+        "[\n    1,\n    2,\n]", "[1, 2, 3, 4, 5]"
+    ).replace("dict(key='value')", 'dict(key="value", other=1)')
+
+    # Quotes inside ordinary strings and comments don't start triple-quoted strings
+    source = "s = \"'''\"  # '''\ndoc = '''\nx = [5]\n'''\nx = [1]\n"
+    code = Code(source, engine="tokens")
+    code.find_list("x").append(2)
+    assert code.splice() == source.replace("x = [1]", "x = [1, 2]")
+    assert str(code) == code.splice()
+
+    # Changes that can't be located render the whole tree
+    code.invalidate_index()
+    assert code.splice() is None
+    assert str(code).endswith("\nx = [1, 2]\n")
+
+
+def test_file_mmap(tmp_path, monkeypatch):
+    import os
+
+    temp_file = tmp_path / "test_file.py"
+    source = "# héader\nmy_list = [\n    'ü',\n]  # trailing\nmy_dict = {}\n"
+    temp_file.write_text(source, encoding="utf-8")
+    temp_file.chmod(0o640)
+    replace = os.replace
+
+    def unmapped_replace(src, dst):
+        # Windows can't replace a mapped file
+        assert file._mmap is None
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", unmapped_replace)
+    with File(str(temp_file), read_mode="mmap") as file:
+        file.find_list("my_list").append("é")
+        assert file.load("my_dict") == {}
+
+    assert temp_file.read_text(encoding="utf-8") == source.replace(
+        "[\n    'ü',\n]", '["ü", "é"]'
+    )
+    if sys.platform != "win32":
+        assert temp_file.stat().st_mode & 0o777 == 0o640
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["test_file.py"]
+
+    with pytest.raises(ValueError):
+        File(str(temp_file), read_mode="mmap", engine="ast")
+
+
+def test_file_write_is_atomic(tmp_path, monkeypatch):
+    temp_file = tmp_path / "test_file.py"
+    temp_file.write_text("my_list = [1]\n")
+    inode = temp_file.stat().st_ino
+    fsyncs = []
+    monkeypatch.setattr(code_crafter.os, "fsync", fsyncs.append)
+
+    with File(str(temp_file), fsync=True) as file:
+        file.find_list("my_list").append(2)
+    assert temp_file.read_text() == "my_list = [1, 2]\n"
+    assert temp_file.stat().st_ino != inode
+    # The file, and its directory where that's possible
+    assert len(fsyncs) == (2 if hasattr(code_crafter.os, "O_DIRECTORY") else 1)
+
+    # A failed write leaves the file as it was
+    with pytest.raises(ZeroDivisionError):
+        with File(str(temp_file), formatter=lambda text, line_length: 1 / 0) as file:
+            file.find_list("my_list").append(3)
+    assert temp_file.read_text() == "my_list = [1, 2]\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["test_file.py"]
+
+
+@pytest.mark.parametrize(
+    "edit, expected, in_place",
+    [
+        (lambda my_list: my_list.__setitem__(0, 9), "my_list = [9, 2]", True),
+        (lambda my_list: my_list.append(3), "my_list = [1, 2, 3]", True),
+        (lambda my_list: my_list.extend(range(100)), None, False),
+    ],
+)
+def test_file_patch(tmp_path, edit, expected, in_place):
+    temp_file = tmp_path / "test_file.py"
+    tail = "".join(f"value_{i} = {i}\n" for i in range(100 if in_place else 10_000))
+    # Written as bytes, so the line endings are "\n" on Windows too
+    temp_file.write_bytes(f"# héader\nmy_list = [1, 2]\n{tail}".encode("utf-8"))
+    inode = temp_file.stat().st_ino
+
+    with File(str(temp_file), write_mode="patch") as file:
+        edit(file.find_list("my_list"))
+        new_list = file.find_list("my_list").to_python()
+
+    assert (temp_file.stat().st_ino == inode) == in_place
+    source = temp_file.read_bytes().decode("utf-8")
+    assert source.endswith(tail)
+    assert Code(source).load("my_list") == new_list
+    if expected is not None:
+        assert source == f"# héader\n{expected}\n{tail}"
+
+
+@pytest.mark.parametrize("write_mode", ["full", "splice"])
+def test_file_formatter(tmp_path, write_mode):
+    temp_file = tmp_path / "test_file.py"
+    temp_file.write_text("x = 1\nmy_list = [1]\n")
+    formatted = []
+
+    def formatter(text, line_length):
+        formatted.append(text)
+        return text.upper()
+
+    with File(str(temp_file), write_mode=write_mode, formatter=formatter) as file:
+        file.find_list("my_list").append(2)
+
+    if write_mode == "full":
+        assert formatted == ["x = 1\nmy_list = [1, 2]\n"]
+        assert temp_file.read_text() == "X = 1\nMY_LIST = [1, 2]\n"
+    else:
+        assert formatted == ["my_list = [1, 2]\n"]
+        assert temp_file.read_text() == "x = 1\nMY_LIST = [1, 2]\n"
+
+    with File(str(temp_file), formatter="none", write_mode=write_mode) as file:
+        file.find_list("MY_LIST").append('a')
+    assert "MY_LIST = [1, 2, 'a']\n" in temp_file.read_text()
+
+    with pytest.raises(ValueError):
+        File(str(temp_file), formatter="yapf")
+
+
+def test_tokens_engine_requires_splice():
+    with pytest.raises(ValueError):
+        File("unused.py", engine="tokens", write_mode="full")
+    with pytest.raises(ValueError):
+        Code("x = 1", engine="tree-sitter")
+
+
+def test_file_unchanged_skips_write(temp_python_file):
+    with open(temp_python_file, "r") as f:
+        original = f.read()
+    skipped = File.skipped_writes
+
+    with File(temp_python_file) as file:
+        assert file.find_dict("my_dict").get("key") == "value"
+        file.find_dict("my_dict").pop("missing")
+
+    assert File.skipped_writes == skipped + 1
+    with open(temp_python_file, "r") as f:
+        assert f.read() == original
+
+    with File(temp_python_file) as file:
+        file.find_list("my_list").append(4)
+
+    assert File.skipped_writes == skipped + 1
+    with open(temp_python_file, "r") as f:
+        assert "my_list = [1, 2, 3, 4]" in f.read()
+
+
+@pytest.mark.parametrize("document", ["sample_document", "sample_document2"])
+def test_code_modified(document, request):
+    sample_document = request.getfixturevalue(document)
+    assert not sample_document.modified
+    sample_document.find_dict('my_dict').get('key')
+    assert not sample_document.modified
+
+    # Calls that change nothing don't mark the code as modified
+    my_dict = sample_document.find_dict('my_dict')
+    my_dict.pop('missing')
+    my_dict.update({})
+    my_dict.update(key='value', num=42)
+    my_list = sample_document.find_list('my_list')
+    my_list.remove_all([])
+    my_list.extend([])
+    my_list.filter(lambda value: True)
+    my_set = sample_document.find_set('my_set')
+    my_set.discard(4)
+    my_set.add(1)
+    my_set.update([2, 3])
+    assert not sample_document.modified
+    assert sample_document.log == []
+
+    sample_document.find_set('my_set').add(4)
+    assert sample_document.modified
+
+
+def append_to_my_list(file):
+    file.find_list("my_list").append(4)
+    return len(file.find_list("my_list").node.value.elts)
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_batch(tmp_path, max_workers):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"module_{i}.py"
+        path.write_text("my_list = [1, 2, 3]\n" if i != 2 else "other = 1\n")
+        paths.append(str(path))
+
+    results = batch(paths, append_to_my_list, max_workers=max_workers, chunksize=3)
+
+    assert [result.path for result in results] == paths
+    assert [result.ok for result in results] == [True, True, False, True]
+    assert results[0].result == 4
+    assert "AttributeError" in results[2].error
+    assert (tmp_path / "module_0.py").read_text() == "my_list = [1, 2, 3, 4]\n"
+    assert (tmp_path / "module_2.py").read_text() == "other = 1\n"
+
+
+def test_parse_cache(temp_python_file, tmp_path):
+    cache = ParseCache(directory=str(tmp_path / "cache"))
+
+    with File(temp_python_file, cache=cache) as file:
+        file.find_list("my_list").append(4)
+
+    code = cache.load(temp_python_file)
+    code.find_list("my_list").append(5)
+    # Each load gets its own copy of the tree
+    assert "[1, 2, 3, 4]" in str(cache.load(temp_python_file))
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["hits"] == 1
+
+    # A new cache picks the parsed tree up from disk
+    other = ParseCache(directory=str(tmp_path / "cache"))
+    assert "[1, 2, 3, 4]" in str(other.load(temp_python_file))
+    assert other.stats()["disk_hits"] == 1
+
+
+def test_parse_cache_eviction(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"module_{i}.py"
+        path.write_text(f"x = [{i}]\n")
+        paths.append(str(path))
+
+    cache = ParseCache(max_entries=2, hash_contents=True)
+    for path in paths:
+        cache.load(path)
+    assert cache.stats()["entries"] == 2
+    cache.load(paths[0])
+    cache.load(paths[2])
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 4
+
+
+@pytest.mark.parametrize("source_code", ["d = {'a': 0, x: 1, 'b': 2}", "d = dict(a=0, **x, b=2)"])
+def test_dict_index_stays_consistent(source_code):
+    import random
+
+    my_dict = Code(source_code).find_dict('d')
+    expected = {'a': 0, 'b': 2}
+    rng = random.Random(0)
+    for step in range(300):
+        key = rng.choice("abcdefgh")
+        if rng.random() < 0.6:
+            my_dict.update({key: step})
+            expected[key] = step
+        else:
+            popped = my_dict.pop(key)
+            assert (popped.value if popped is not None else None) == expected.pop(key, None)
+        assert all(my_dict.get(k) == v for k, v in expected.items())
+        assert my_dict.get('missing') is None
+
+
+def test_dict_index_duplicate_keys():
+    my_dict = Code("d = {'a': 0, 'b': 1, 'a': 2}").find_dict('d')
+    assert my_dict.get('a') == 0
+    my_dict.pop('a')
+    assert my_dict.get('a') == 2
+    assert my_dict.get('b') == 1
+
+
+@pytest.mark.parametrize("source_code", ["my_set = {1, 'a', x}", "my_set = set(1, 'a', x)"])
+def test_set_index(source_code):
+    my_set = Code(source_code).find_set('my_set')
+    assert 'a' in my_set
+    assert 'b' not in my_set
+    assert [1] not in my_set
+    assert len(my_set) == 3
+
+    my_set.update(['b', 'c', 'b', 1])
+    assert len(my_set) == 5
+    my_set.remove('a')
+    my_set.discard('missing')
+    assert 'b' in my_set and 'c' in my_set and 'a' not in my_set
+    my_set.add('a')
+    assert len(my_set) == 5
+    with pytest.raises(KeyError):
+        my_set.remove('d')
+
+
+@pytest.mark.parametrize("document", ["sample_document", "sample_document2"])
+def test_list_bulk_operations(document, request):
+    code = request.getfixturevalue(document)
+    my_list = code.find_list('my_list')
+    my_list.extend([4, 2, 'b'])
+    assert len(my_list) == 7
+    my_list.remove_all([2, 'a', 'missing'])
+    assert [elt.value for elt in my_list._elts()] == [1, 3, 4, 'b']
+    assert "1, 3, 4, 'b'" in str(code)
+    my_list.filter(lambda value: value != 'b')
+    my_list[0] = 5
+    my_list[1:2] = [6, 7]
+    assert [elt.value for elt in my_list._elts()] == [5, 6, 7, 4]
+    my_list.sort()
+    assert [elt.value for elt in my_list._elts()] == [4, 5, 6, 7]
+    my_list.sort(key=lambda value: -value)
+    assert [elt.value for elt in my_list._elts()] == [7, 6, 5, 4]
+    my_list.append([1])
+    with pytest.raises(TypeError):
+        my_list.sort()
+    my_list.clear()
+    assert len(my_list) == 0
+
+
+class Color(enum.Enum):
+    RED = 1
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: Any = None
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (frozenset(), "frozenset()"),
+        (frozenset({1}), "frozenset({1})"),
+        (set(), "set()"),
+        (b"ab", "b'ab'"),
+        ([None, True, ...], "[None, True, ...]"),
+        (Color.RED, "Color.RED"),
+        (Point(1, Point(2, [Color.RED])), "Point(x=1, y=Point(x=2, y=[Color.RED]))"),
+        ({"a": (1, "b")}, "{'a': (1, 'b')}"),
+        (range(3), "[0, 1, 2]"),
+        (array.array("d", [0.5, 2]), "[0.5, 2.0]"),
+        (memoryview(b"ab"), "[97, 98]"),
+        (array.array("u", "ab"), "['a', 'b']"),
+    ],
+)
+def test_get_ast_node_from_value(value, expected):
+    assert astor.to_source(get_ast_node_from_value(value)).strip() == expected
+
+
+def test_get_ast_node_from_value_deeply_nested():
+    value = []
+    for _ in range(sys.getrecursionlimit() * 2):
+        value = [value]
+    node = get_ast_node_from_value(value)
+    for _ in range(sys.getrecursionlimit() * 2):
+        node = node.elts[0]
+    assert isinstance(node, ast.List) and node.elts == []
+
+
+def test_get_ast_node_from_value_custom_builder(monkeypatch):
+    monkeypatch.setitem(
+        code_crafter.ast_map, range, lambda x: ast.Call(
+            func=ast.Name(id="range", ctx=ast.Load()), args=[x.start, x.stop], keywords=[]
+        )
+    )
+    node = get_ast_node_from_value({"r": range(1, 3)})
+    assert astor.to_source(node).strip() == "{'r': range(1, 3)}"
+
+
+def test_to_python():
+    code = Code("""
+my_dict = {'a': [1, (2, 3)], 'b': {'c': None}, 4: -1.5}
+my_call_dict = dict(a=list(1, 2), b=set([3]), c=frozenset({4}))
+my_list = [1, 'a', {1, 2}, [], b'x']
+my_set = set(1, 'a')
+other = 1 + x
+""")
+    assert code.find_dict('my_dict').to_python() == {'a': [1, (2, 3)], 'b': {'c': None}, 4: -1.5}
+    assert code.find_dict('my_call_dict').to_python() == {'a': [1, 2], 'b': {3}, 'c': frozenset({4})}
+    assert code.find_list('my_list').to_python() == [1, 'a', {1, 2}, [], b'x']
+    assert code.find_set('my_set').to_python() == {1, 'a'}
+    assert code.load('my_dict') == code.find_dict('my_dict').to_python()
+    assert code.find_dict('my_dict').get('b') == {'c': None}
+    assert list(code.find_dict('my_dict')) == ['a', 'b', 4]
+    with pytest.raises(ValueError):
+        code.load('other')
+    with pytest.raises(KeyError):
+        code.load('missing')
+
+
+def test_items_are_lazy():
+    my_dict = Code("d = {'a': 1, 'b': x}").find_dict('d')
+    items = my_dict.items()
+    assert next(items) == ('a', 1)
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_find_all():
+    import re
+
+    code = Code("""
+registry = {'a': 1}
+plugins: list = ['x']
+a, (b, c) = [1], ({2}, dict(k=1))
+x = y = [0]
+class MyClass:
+    registry = {'b': 2}
+    def __init__(self):
+        self.items = [1]
+        if True:
+            self.flags = {1}
+try:
+    handlers = []
+except ValueError:
+    fallback = {}
+registry = ['second']
+""")
+    found = code.find_all()
+    assert {name: wrapper.to_python() for name, wrapper in found.items()} == {
+        'registry': {'a': 1},
+        'plugins': ['x'],
+        'a': [1],
+        'b': {2},
+        'c': {'k': 1},
+        'x': [0],
+        'y': [0],
+        'MyClass.registry': {'b': 2},
+        'MyClass.__init__.self.items': [1],
+        'MyClass.__init__.self.flags': {1},
+        'handlers': [],
+        'fallback': {},
+    }
+
+    assert list(code.find_all('*registry')) == ['registry', 'MyClass.registry']
+    assert list(code.find_all('registry', kinds=['list'])) == ['registry']
+    assert code.find_all('registry', kinds=[code_crafter.List])['registry'].to_python() == ['second']
+    assert list(code.find_all(re.compile(r'.*self\.\w+'), kinds=['set'])) == ['MyClass.__init__.self.flags']
+    assert list(code.find_all(['registry', '__init__.*'], scope='MyClass')) == [
+        'registry', '__init__.self.items', '__init__.self.flags'
+    ]
+
+    found['plugins'].append('y')
+    found['b'].add(3)
+    found['MyClass.__init__.self.items'].append(2)
+    assert code.load('plugins') == ['x', 'y']
+    assert found['MyClass.__init__.self.items'].to_python() == [1, 2]
+    assert "{2, 3}" in code.splice()
+
+
+@pytest.mark.parametrize("use_executor", [False, True])
+def test_async_file(temp_python_file, use_executor):
+    import asyncio
+    import concurrent.futures
+
+    async def edit(executor):
+        async with AsyncFile(temp_python_file, executor=executor) as file:
+            file.find_list('my_list').append(4)
+            return file.load('my_dict')
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        result = asyncio.run(edit(executor if use_executor else None))
+
+    assert result == {'key': 'value'}
+    with File(temp_python_file) as file:
+        assert file.load('my_list') == [1, 2, 3, 4]
+
+
+def test_async_batch(tmp_path):
+    import asyncio
+
+    paths = []
+    for i in range(20):
+        path = tmp_path / f"module_{i}.py"
+        path.write_text(f"my_list = [{i}]\n")
+        paths.append(str(path))
+    paths.append(str(tmp_path / "missing.py"))
+
+    async def edit(file):
+        await asyncio.sleep(0)
+        file.find_list('my_list').append(-1)
+        return file.load('my_list')[0]
+
+    results = asyncio.run(async_batch(paths, edit, max_concurrency=4, write_mode='splice'))
+
+    assert [result.result for result in results[:-1]] == list(range(20))
+    assert not results[-1].ok and 'FileNotFoundError' in results[-1].error
+    assert (tmp_path / "module_7.py").read_text() == "my_list = [7, -1]\n"
+
+
+LOG_SOURCE = """my_dict = {'a': 1}
+my_list = [1, 2]
+my_set = {1}
+class Config:
+    registry = dict(x=1)
+"""
+
+
+def test_operation_log():
+    code = Code(LOG_SOURCE)
+    my_list = code.find_list('my_list')
+    my_list.extend(iter([3, 4]))
+    my_list.sort(reverse=True)
+    code.find_all('Config.registry')['Config.registry'].update(y=2)
+    code_crafter.LiteralList(ast.parse('[1]').body[0].value).append(2)
+
+    assert code.log == [
+        Operation('list', 'my_list', 'extend', ([3, 4],)),
+        Operation('list', 'my_list', 'sort', (), {'reverse': True}),
+        Operation('dict', 'Config.registry', 'update', (), {'y': 2}),
+    ]
+
+    other = Code(LOG_SOURCE)
+    assert other.replay(code_crafter.deserialize_log(code_crafter.serialize_log(code.log))) == 3
+    assert other.splice() == code.splice()
+
+    with pytest.raises(KeyError):
+        Code("x = 1").replay(code.log)
+    assert Code("my_list = []").replay(code.log, strict=False) == 2
+    # Only methods that modify the container can be replayed
+    for method in ['to_python', '__setattr__']:
+        with pytest.raises(ValueError):
+            Code("my_list = []").replay([Operation('list', 'my_list', method, ('node', None))])
+
+    my_list.filter(lambda value: value > 2)
+    with pytest.raises(ValueError):
+        code_crafter.serialize_log(code.log)
+
+    # Containers found in a scope or by unpacking are logged so replay finds them
+    source = "registry = {}\nfirst, second = [1], [2]\nclass Config:\n    registry = {}\n"
+    code = Code(source)
+    code.find_all('registry', scope='Config')['registry'].update(a=1)
+    code.find_all('second')['second'].append(3)
+    assert [operation.name for operation in code.log] == ['Config.registry', 'second']
+    other = Code(source)
+    assert other.replay(code.log) == 2
+    assert other.splice() == code.splice()
+    assert other.load('registry') == {}
+
+    # Arguments changed after the call don't change the log
+    code = Code("my_dict = {}\n")
+    payload = {'a': [1]}
+    code.find_dict('my_dict').update(payload)
+    payload['a'].append(2)
+    payload['b'] = 2
+    assert code.log == [Operation('dict', 'my_dict', 'update', ({'a': [1]},))]
+
+
+def test_compact_log():
+    import random
+
+    rng = random.Random(0)
+    operations = [
+        lambda code: code.find_dict('my_dict').update({rng.choice('abc'): rng.random()}),
+        lambda code: code.find_dict('my_dict').update(**{rng.choice('abc'): 1}),
+        lambda code: code.find_dict('my_dict').pop(rng.choice('abc')),
+        lambda code: code.find_list('my_list').append(rng.randrange(5)),
+        lambda code: code.find_list('my_list').extend([rng.randrange(5)] * 2),
+        lambda code: code.find_list('my_list').pop(-1) if len(code.find_list('my_list')) else None,
+        lambda code: code.find_set('my_set').add(rng.randrange(5)),
+        lambda code: code.find_set('my_set').discard(rng.randrange(5)),
+        lambda code: code.find_set('my_set').update([rng.randrange(5)]),
+        lambda code: code.find_dict('my_dict').clear(),
+        lambda code: code.find_list('my_list').clear(),
+    ]
+    for _ in range(20):
+        code = Code(LOG_SOURCE)
+        for _ in range(30):
+            rng.choice(operations)(code)
+        compacted = code_crafter.compact_log(code.log)
+        assert len(compacted) <= len(code.log)
+
+        other = Code(LOG_SOURCE)
+        other.replay(compacted)
+        for name in ['my_dict', 'my_list', 'my_set']:
+            assert other.load(name) == code.load(name)
+
+    code = Code(LOG_SOURCE)
+    code.find_dict('my_dict').update({'b': 2})
+    code.find_list('my_list').append(3)
+    code.find_dict('my_dict').pop('b')
+    code.find_list('my_list').extend([4])
+    assert code_crafter.compact_log(code.log) == [
+        Operation('dict', 'my_dict', 'pop', ('b',)),
+        Operation('list', 'my_list', 'extend', ([3, 4],)),
+    ]
+
+
+def test_replay_batch(tmp_path):
+    import functools
+
+    code = Code(LOG_SOURCE)
+    code.find_list('my_list').append(3)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"module_{i}.py"
+        path.write_text(LOG_SOURCE)
+        paths.append(str(path))
+
+    results = batch(paths, functools.partial(File.replay, operations=code.log), max_workers=1)
+    assert [result.result for result in results] == [1, 1, 1]
+    with File(paths[0]) as file:
+        assert file.load('my_list') == [1, 2, 3]
+
+
+def test_profile(temp_python_file):
+    import json
+
+    with File(temp_python_file, write_mode="splice", profile=True) as file:
+        file.find_list('my_list').append(4)
+        file.load('my_dict')
+
+    data = json.loads(file.profile.to_json())
+    assert data['name'] == temp_python_file
+    for phase in ['read', 'parse', 'index', 'mutate', 'render', 'format', 'write']:
+        assert data[f'{phase}_calls'] == 1
+        assert data[f'{phase}_seconds'] >= 0
+    assert data['lookup_calls'] == 2
+    assert data['write_seconds'] >= data['format_seconds']
+    assert data['nodes'] > 0
+    with open(temp_python_file, 'rb') as f:
+        assert data['bytes_written'] == len(f.read())
+
+    results = batch([temp_python_file], append_to_my_list, max_workers=1, profile=True)
+    assert results[0].profile['bytes_read'] == data['bytes_written']
+
+
+def test_import_does_not_load_formatters():
+    import os
+    import subprocess
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import code_crafter"],
+        cwd=os.path.dirname(os.path.abspath(code_crafter.__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    imported = {line.rsplit("|", 1)[-1].strip() for line in result.stderr.splitlines()}
+    assert "code_crafter" in imported
+    assert not {"black", "astor", "concurrent.futures"} & imported
+
+
+def test_server_coalesces_edits(tmp_path):
+    path = tmp_path / "config.py"
+    path.write_text("my_list = [1]\nmy_dict = {'a': 1}\n")
+    server = Server(str(tmp_path / "server.sock"), flush_delay=60, formatter="none")
+
+    def edit(*operations, **fields):
+        return server.handle(
+            dict(fields, op="edit", path=str(path), operations=code_crafter.serialize_log(operations))
+        )
+
+    assert edit(Operation("list", "my_list", "append", (2,))) == {"applied": 1}
+    assert edit(Operation("dict", "my_dict", "update", ({"b": {2}},))) == {"applied": 1}
+    assert server.handle({"op": "load", "path": str(path), "name": "my_dict"}) == {"value": "{'a': 1, 'b': {2}}"}
+    assert server.handle({"op": "find", "path": str(path), "name": "my_list"}) == {"kind": "list", "source": "[1, 2]"}
+    assert path.read_text() == "my_list = [1]\nmy_dict = {'a': 1}\n"
+
+    # A failed edit leaves the file as it was before the request
+    response = edit(Operation("list", "my_list", "append", (3,)), Operation("set", "missing", "add", (1,)))
+    assert response["type"] == "KeyError"
+    assert server.handle({"op": "load", "path": str(path), "name": "my_list"}) == {"value": "[1, 2]"}
+
+    # Pending edits survive the file changing on disk
+    path.write_text("my_list = [0, 1]\nmy_dict = {}\n")
+    assert edit(Operation("list", "my_list", "pop", (0,)), flush=True) == {"applied": 1}
+    assert path.read_text() == "my_list = [1, 2]\nmy_dict = {'b': {2}}\n"
+    assert server.writes == 1
+
+    assert edit(Operation("list", "my_list", "append", (3,))) == {"applied": 1}
+    assert server.handle({"op": "flush"}) == {"written": [str(path)]}
+    assert path.read_text() == "my_list = [1, 2, 3]\nmy_dict = {'b': {2}}\n"
+    # Read initially, to roll back the failed edit and after the change on disk
+    assert server.handle({"op": "stats"})["misses"] == 3
+
+
+@pytest.mark.skipif(not hasattr(__import__("socket"), "AF_UNIX"), reason="requires Unix sockets")
+def test_server_socket(tmp_path, capsys):
+    import json
+    import socket
+    import threading
+
+    path = tmp_path / "config.py"
+    path.write_text("my_list = [1]\n")
+    socket_path = str(tmp_path / "server.sock")
+    server = Server(socket_path, formatter="none", write_mode="splice")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        for _ in range(100):
+            if (tmp_path / "server.sock").exists():
+                break
+            thread.join(0.01)
+        with Client(socket_path) as client:
+            assert client.edit(str(path), [Operation("list", "my_list", "append", ("a",))]) == 1
+            # Other clients are served while this one stays connected
+            with Client(socket_path) as other:
+                assert other.load(str(path), "my_list") == [1, "a"]
+            with pytest.raises(KeyError):
+                client.find(str(path), "missing")
+
+            # Malformed requests and clients leaving without reading the response
+            # only affect their own connection
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as raw:
+                raw.connect(socket_path)
+                raw.sendall(b'not json\n["op"]\n')
+                responses = raw.makefile("rb")
+                assert json.loads(responses.readline())["type"] == "ValueError"
+                assert json.loads(responses.readline())["type"] == "ValueError"
+                responses.close()
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as raw:
+                raw.connect(socket_path)
+                raw.sendall(b'{"op": "stats"}\n' * 1000)
+            assert client.stats()["files"] == 1
+
+        assert code_crafter.main(["--socket", socket_path, "edit", str(path), "list", "my_list", "extend", "[{2}]"]) == 0
+        assert code_crafter.main(["--socket", socket_path, "load", str(path), "my_list"]) == 0
+        assert capsys.readouterr().out == "[1, 'a', {2}]\n"
+        assert code_crafter.main(["--socket", socket_path, "edit", str(path), "set", "x", "add", "1"]) == 1
+    finally:
+        assert code_crafter.main(["--socket", socket_path, "stop"]) == 0
+        thread.join()
+
+    # Pending edits are written when the server stops
+    assert path.read_text() == "my_list = [1, 'a', {2}]\n"
+    assert not (tmp_path / "server.sock").exists()
+
+
+NESTED_SOURCE = """CONFIG = {
+    'services': {'api': {'workers': 2, 'hosts': ['a', 'b']}, 'db': dict(pool=[1])},
+    'flags': {1, 2},
+}
+"""
+
+
+def test_at():
+    code = Code(NESTED_SOURCE)
+    api = code.at('CONFIG', 'services', 'api')
+    assert api.to_python() == {'workers': 2, 'hosts': ['a', 'b']}
+    assert code.at('CONFIG', 'services', 'api') is api
+    hosts = code.at('CONFIG', 'services', 'api', 'hosts')
+    hosts.append('c')
+    assert code.at('CONFIG', 'services', 'api', 'hosts') is hosts
+    code.at('CONFIG', 'services', 'db', 'pool').extend([2, 3])
+    assert code.at('CONFIG', 'flags').to_python() == {1, 2}
+
+    for path, error in [
+        (('CONFIG', 'missing'), KeyError),
+        (('MISSING',), KeyError),
+        (('CONFIG', 'services', 'api', 'hosts', 5), KeyError),
+        (('CONFIG', 'services', 'api', 'workers'), TypeError),
+        (('CONFIG', 'services', 'api', 'hosts', 'x'), TypeError),
+        (('CONFIG', 'flags', 1), TypeError),
+    ]:
+        with pytest.raises(error):
+            code.at(*path)
+
+    # Modifying a container drops the cached paths inside it
+    code.at('CONFIG', 'services').update({'api': {'hosts': []}})
+    assert code.at('CONFIG', 'services', 'api', 'hosts') is not hosts
+    code.at('CONFIG', 'services', 'api', 'hosts').append('z')
+    assert code.load('CONFIG')['services']['api'] == {'hosts': ['z']}
+    assert code.at('CONFIG', 'services', 'db', 'pool').to_python() == [1, 2, 3]
+
+    assert [operation.name for operation in code.log] == [
+        "CONFIG['services']['api']['hosts']",
+        "CONFIG['services']['db']['pool']",
+        "CONFIG['services']",
+        "CONFIG['services']['api']['hosts']",
+    ]
+    serialized = code_crafter.serialize_log(code.log)
+    other = Code(NESTED_SOURCE)
+    assert other.replay(code_crafter.deserialize_log(serialized)) == 4
+    assert other.splice() == code.splice()
+
+    # The replacement of 'api' can't be merged with the append before it
+    compacted = code_crafter.compact_log(code.log)
+    assert [operation.method for operation in compacted] == ['append', 'extend', 'update', 'append']
+    other = Code(NESTED_SOURCE)
+    other.replay(compacted)
+    assert other.load('CONFIG') == code.load('CONFIG')
+
+
+@pytest.mark.parametrize("size", [3, 2000])
+def test_array_values(size):
+    values = [i / 4 for i in range(size)]
+    for value in [array.array("d", values), memoryview(array.array("d", values))]:
+        node = get_ast_node_from_value(value)
+        assert get_value_from_ast_node(node) == values
+        assert ast.literal_eval(astor.to_source(node)) == values
+
+    # Large arrays are rendered straight to text, except when that wouldn't be a literal
+    node = get_ast_node_from_value(range(size))
+    assert isinstance(node, code_crafter._RawList) == (size >= code_crafter._RAW_LITERAL_MIN_SIZE)
+    assert get_value_from_ast_node(node) == list(range(size))
+    assert ast.literal_eval(astor.to_source(node)) == list(range(size))
+    # They are still real list nodes, whose elements are parsed when they're needed
+    assert ast.literal_eval(node) == list(range(size))
+    tree = ast.Module(body=[ast.Assign(targets=[ast.Name(id="x", ctx=ast.Store())], value=node)], type_ignores=[])
+    namespace = {}
+    exec(compile(ast.fix_missing_locations(tree), "<test>", "exec"), namespace)
+    assert namespace["x"] == list(range(size))
+    node = get_ast_node_from_value(array.array("d", [float("inf")] * size))
+    assert isinstance(node, ast.List)
+
+    code = Code("my_list = [1]\nmy_dict = {}\n")
+    code.find_list("my_list").extend(range(size))
+    code.find_dict("my_dict").update({"table": [range(2), range(size)]})
+    assert code.splice().count("__code_crafter_raw") == 0
+    assert len(code.find_list("my_list")) == size + 1
+    assert ast.literal_eval(code.splice()[len("my_list = "):].split("\n")[0]) == [1, *range(size)]
+    assert code.at("my_dict", "table").to_python() == [[0, 1], list(range(size))]
+
+
+def test_numpy_values():
+    numpy = pytest.importorskip("numpy")
+    matrix = numpy.arange(6000).reshape(2, 3000) / 8
+
+    for value in [matrix, matrix.astype(numpy.float32), matrix > 100, matrix.astype(int), matrix[0, :3]]:
+        assert get_value_from_ast_node(get_ast_node_from_value(value)) == value.tolist()
+    assert astor.to_source(get_ast_node_from_value(numpy.array(["a", "b"]))).strip() == "['a', 'b']"
+    assert astor.to_source(get_ast_node_from_value([numpy.int64(1), numpy.float64(0.5)])).strip() == "[1, 0.5]"
+
+    code = Code("table = list()\n")
+    code.find_list("table").extend(matrix)
+    code.find_list("table").extend(numpy.arange(2))
+    assert len(code.find_list("table")) == 4
+    assert code.load("table") == [*matrix.tolist(), 0, 1]
+
+    # Small rows are built node by node
+    code = Code("table = []\n")
+    code.find_list("table").extend(numpy.arange(6).reshape(3, 2))
+    assert code.splice() == "table = [[0, 1], [2, 3], [4, 5]]\n"
+
+
+def _append_pid(file):
+    import os
+
+    file.find_list('my_list').append(os.getpid())
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires fcntl")
+@pytest.mark.parametrize("mode", ["lock", "queue"])
+def test_file_concurrent_writers(tmp_path, mode):
+    path = tmp_path / "registry.py"
+    path.write_text("my_list = []\nmy_dict = {}\n")
+
+    # Changes made by another writer after the file was read are kept
+    with File(str(path), formatter="none", profile=True, **{mode: True}) as file:
+        file.find_dict('my_dict').update({'a': 1})
+        with File(str(path), formatter="none", write_mode="splice") as other:
+            other.find_list('my_list').append(0)
+    assert path.read_text() == "my_list = [0]\nmy_dict = {'a': 1}\n"
+    assert file.profile.counts["rereads"] == 1
+
+    results = batch([str(path)] * 8, _append_pid, max_workers=2, formatter="none", **{mode: True})
+    assert all(result.ok for result in results)
+    assert len(Code(path.read_text()).load('my_list')) == 9
+    # Lock and queue files are kept out of the source tree
+    assert [p.name for p in tmp_path.iterdir()] == ["registry.py"]
+
+    with pytest.raises(KeyError):
+        with File(str(path), formatter="none", **{mode: True}) as file:
+            file.find_list('my_list').append(1)
+            path.write_text("my_dict = {}\n")
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires fcntl")
+def test_file_lock_dir(tmp_path, monkeypatch):
+    import os
+    import tempfile
+
+    path = tmp_path / "registry.py"
+    path.write_text("my_list = []\n")
+    monkeypatch.setattr(tempfile, "gettempdir", lambda: str(tmp_path / "tmp"))
+    lock_dir = tmp_path / "tmp" / f"code_crafter-{os.getuid()}"
+
+    # The default directory is private to the user
+    (tmp_path / "tmp").mkdir()
+    with File(str(path), formatter="none", lock=True) as file:
+        file.find_list('my_list').append(1)
+    assert lock_dir.stat().st_mode & 0o777 == 0o700
+    assert len(os.listdir(lock_dir)) == 1
+
+    # and isn't used if others can write to it
+    lock_dir.chmod(0o777)
+    with pytest.raises(PermissionError):
+        with File(str(path), formatter="none", lock=True) as file:
+            file.find_list('my_list').append(2)
+    assert path.read_text() == "my_list = [1]\n"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires fcntl")
+def test_file_queue_merges_edits(tmp_path, monkeypatch):
+    import json
+    import os
+
+    path = tmp_path / "registry.py"
+    path.write_text("my_list = []\n")
+    queued = [
+        {"id": "first", "operations": code_crafter.serialize_log([Operation('list', 'my_list', 'append', (1,))])},
+        {"id": "missing", "operations": code_crafter.serialize_log([Operation('set', 'my_set', 'add', (1,))])},
+    ]
+    lock_dir = tmp_path / "locks"
+    queue = File(str(path), lock_dir=str(lock_dir))._sidecar(".queue")
+    # Edits queued by other processes, which haven't taken the lock yet
+    open(queue, "w").write("".join(json.dumps(record) + "\n" for record in queued))
+
+    with File(str(path), formatter="none", queue=True, lock_dir=str(lock_dir), profile=True) as file:
+        file.find_list('my_list').append(2)
+    assert path.read_text() == "my_list = [1, 2]\n"
+    assert file.profile.counts["queued_edits"] == 3
+    assert open(queue).read() == ""
+    assert json.loads(open(queue + "-errors").read())["id"] == "missing"
+    key = os.path.basename(queue)[:-len(".queue")]
+    assert sorted(os.listdir(lock_dir)) == [key + ".lock", key + ".queue", key + ".queue-errors"]
+
+    # Edits queued after ours were written by another process are still applied
+    first = File(str(path), formatter="none", queue=True, lock_dir=str(lock_dir)).__enter__()
+    second = File(str(path), formatter="none", queue=True, lock_dir=str(lock_dir)).__enter__()
+    first.find_list('my_list').append(3)
+    second.find_list('my_list').append(4)
+    locked = File._locked
+
+    def second_goes_first(self, exclusive):
+        monkeypatch.setattr(File, "_locked", locked)
+        second.__exit__(None, None, None)
+        record = {"id": "last", "operations": code_crafter.serialize_log([Operation('list', 'my_list', 'append', (5,))])}
+        with open(queue, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return locked(self, exclusive)
+
+    monkeypatch.setattr(File, "_locked", second_goes_first)
+    first.__exit__(None, None, None)
+    assert path.read_text() == "my_list = [1, 2, 3, 4, 5]\n"
+
+    # A failed write leaves the edits queued by other processes for them to apply
+    record = {"id": "other", "operations": code_crafter.serialize_log([Operation('list', 'my_list', 'append', (6,))])}
+    with open(queue, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    def failing_formatter(text, line_length):
+        raise ValueError("can't format")
+
+    with pytest.raises(ValueError):
+        with File(str(path), formatter=failing_formatter, queue=True, lock_dir=str(lock_dir)) as file:
+            file.find_list('my_list').append(7)
+    assert path.read_text() == "my_list = [1, 2, 3, 4, 5]\n"
+    assert [json.loads(line)["id"] for line in open(queue)] == ["other"]
+
+    file = File(str(path), queue=True).__enter__()
+    file.code.tree = ast.parse("my_list = []")
+    with pytest.raises(RuntimeError):
+        file.__exit__(None, None, None)